@@ -1,9 +1,14 @@
 import sys
-import copy
 import inspect
 import os
+import threading
+import time
 from loggers import DefaultLogger
 from switch import read_switches
+import overhead
+import profiling
+import samplers
+import snapshot
 
 MAX_TESTS = 10
 
@@ -19,7 +24,12 @@ class ExampleEngine(object):
     for methods
         input = (*a, **b) where a[0] = self
         output = (f(*a,**b), self)
+
+    snapshot_strategy tells how the input must be copied before the call
+    (see the snapshot module).
     """
+    snapshot_strategy = snapshot.DEEPCOPY
+
     def __init__(self,
                  mfunc=None,
                  mclass=None,
@@ -31,7 +41,8 @@ class ExampleEngine(object):
                  base_name='base',
                  class_name='class',
                  flat_function_name='flat_function',
-                 qualified_function_name='qual_name'):
+                 qualified_function_name='qual_name',
+                 overhead=None):
         self.mfunc = mfunc
         self.mclass = mclass
         self.mattr = mattr
@@ -43,13 +54,16 @@ class ExampleEngine(object):
         self.class_name = class_name
         self.flat_function_name = flat_function_name
         self.qualified_function_name = qualified_function_name
+        # Overhead counters of the function (see the overhead module).
+        self.overhead = overhead
         # How many tests have we already generated?
         self.test_counter = 0
         # Have we already checked all tests?
         self.has_run_tests = False
 
-    def learn(self, input, output):
-        """Learns the desired behavior."""
+    def learn(self, input, output, perf=None):
+        """Learns the desired behavior.  If the calls are profiled,
+        perf is the dictionary of their cost (see the profiling module)."""
         pass
 
     def test(self, input, output):
@@ -64,17 +78,37 @@ class autotest(object):
     - Either mfunc, in which case we are instrumenting a function,
     - or mclass and mattr, which which case we are instrumenting attribute mattr
       of class mclass.
+    sampling is a spec for samplers.make_sampler, deciding which calls are
+    checked; it can be overridden per function in the switches file.
+    If a dispatcher (see dispatch.AsyncDispatcher) is given, the checks are
+    run by the dispatcher rather than on the caller's thread.
+    If perf is True, the sampled calls are profiled, and their cost is
+    passed to the engines as the perf argument of learn.
+    If a budget (see samplers.Budget) is given, the sampling rate is
+    lowered as needed to keep the overhead of autotest within it.
+    engine_options gives the extra arguments of the engines, by engine
+    class, for instance {StatEngine: dict(half_lives=[60, 600, 3600, 86400],
+    histograms=True, max_vars=1000)}.
     """
     def __init__(self, max_tests=10, exit_on_error=True, logger=DefaultLogger(),
-                 engines = [], mfunc=None, mclass=None, mattr=None):
+                 engines = [], mfunc=None, mclass=None, mattr=None, sampling=None,
+                 dispatcher=None, perf=False, budget=None, engine_options=None):
         # Max number of test cases generated, propagated to the various engines.
         self.max_tests = max_tests
         # Exit if there is an error or continue execution
         self.exit_on_error = exit_on_error
         # Where to log the error?
         self.logger = logger
-        # Engines for testing.
+        # Engines for testing, and their extra arguments.
         self.engine_classes = engines
+        self.engine_options = engine_options or {}
+        # Runs the checks asynchronously, if not None.
+        self.dispatcher = dispatcher
+        # Measures the cost of the sampled calls, if not None.
+        self.profiler = profiling.Profiler() if perf else None
+        # Serializes the checks, which may run on several worker threads;
+        # reentrant, as engines may call instrumented functions.
+        self._lock = threading.RLock()
 
         # Builds the various file names associated with the function or method annotated.
         if mfunc is not None:
@@ -102,6 +136,14 @@ class autotest(object):
         # key is tuple that identified this function uniquely
         self.base_name = os.path.join(*name_parts)
         self.subdir_name = os.path.join(self.base_name, self.flat_function_name)
+        self.switches = read_switches(self.module)
+        # Counts the calls, and the time autotest spends on them.
+        self.overhead = overhead.get_counters(self.module, self.qualified_function_name)
+        # Decides which calls are checked.
+        self.sampler = samplers.make_sampler(
+            self.switches.get(samplers.SAMPLING_KEY, {}).get(self.qualified_function_name, sampling))
+        if budget is not None:
+            self.sampler = samplers.AdaptiveSampler(budget, self.overhead, self.sampler)
 
         # Initializes one test engine for each of the testers that it is given.
         self.engines = [e(mfunc=mfunc, # function, or ...
@@ -116,22 +158,39 @@ class autotest(object):
                           class_name=self.class_name, # class/function name
                           flat_function_name=self.flat_function_name, # class + function name
                           qualified_function_name=self.qualified_function_name, # similar to above but not quite
-                          switches=read_switches(self.module)
+                          switches=self.switches,
+                          **self.engine_options.get(e, {})
                           )
                         for e in self.engine_classes]
+        # Set after construction, so that engines need not accept it.
+        for engine in self.engines:
+            engine.overhead = self.overhead
+        # How to snapshot the input: the most expensive strategy any engine needs.
+        self.snapshot_strategy = max([e.snapshot_strategy for e in self.engines] or [snapshot.NO_COPY])
+        # Compiled valuizers of the input and output, by prefix.
+        self.valuizers = {}
 
 
-    def autotest_check(self, func, input, output):
+    def autotest_check(self, func, input, output, perf=None):
         """
         given a func(tion) an input and an output,
         checks that the function satisfies all of the checkers.
+        perf is the cost of the call, if it was profiled.
         """        
-        for engine in self.engines:
-            self.logger.write("calling engine %s for %s.%s" % (engine.__class__.__name__, 
-                                                               self.module,
-                                                               self.qualified_function_name))
-            engine.learn(input, output)
-            engine.test(input, output)
+        with self._lock:
+            for engine in self.engines:
+                self.logger.write("calling engine %s for %s.%s" % (engine.__class__.__name__, 
+                                                                   self.module,
+                                                                   self.qualified_function_name))
+                start = time.time()
+                if perf is None:
+                    engine.learn(input, output)
+                else:
+                    engine.learn(input, output, perf=perf)
+                self.overhead.add('learn', start)
+                start = time.time()
+                engine.test(input, output)
+                self.overhead.add('test', start)
 
 
     def __call__(self, func):
@@ -141,25 +200,57 @@ class autotest(object):
         autotest runs when the function is called.
         """
         def autotest_tmp(*a,**b):
-            input = copy.deepcopy((a,b))
-            output = func(*a,**b)
+            counters = self.overhead
+            counters.calls += 1
+            if not self.sampler.sample():
+                return func(*a,**b)
+            counters.sampled += 1
+            start = time.time()
+            input = snapshot.take(self.snapshot_strategy, (a,b), valuizers=self.valuizers)
+            counters.add('snapshot', start)
+            if self.profiler is not None:
+                state = self.profiler.start()
+                output = func(*a,**b)
+                perf = self.profiler.stop(state)
+            else:
+                output = func(*a,**b)
+                perf = None
             if inspect.ismethod(func):
                 output_and_state = (output, a[0].__dict__)
             else:
                 output_and_state = (output, None)
-            self.autotest_check(func, input, output_and_state)
+            if self.dispatcher is not None:
+                # The output and state may change after we return.
+                start = time.time()
+                output_and_state = snapshot.take(self.snapshot_strategy, output_and_state,
+                                                 snapshot.OUTPUT_PREFIXES, self.valuizers)
+                counters.add('snapshot', start)
+                self.dispatcher.submit(self.autotest_check, func, input, output_and_state, perf)
+            else:
+                self.autotest_check(func, input, output_and_state, perf)
             return output
         autotest_tmp.__name__ = func.__name__
+        autotest_tmp.__wrapped__ = func
         autotest_tmp.__module__ = func.__module__
         return autotest_tmp
 
 def testall(max_tests=MAX_TESTS,
             exit_on_error=True,
             logger=DefaultLogger(),
-            engines=None):
+            engines=None,
+            sampling=None,
+            dispatcher=None,
+            perf=False,
+            budget=None,
+            engine_options=None):
     """
     decorates with autotests all functions and methods defined
-    in the same module where this function is called
+    in the same module where this function is called;
+    sampling is the default sampling spec of each function,
+    dispatcher, if given, runs the checks of all functions,
+    perf tells whether to profile the calls, budget, if given,
+    is the overhead budget shared by all functions, and
+    engine_options the extra arguments of each engine class
     """
     import func_engine
 
@@ -176,7 +267,12 @@ def testall(max_tests=MAX_TESTS,
                       exit_on_error=exit_on_error,
                       logger=logger,
                       engines=engines,
-                      mfunc=func)
+                      mfunc=func,
+                      sampling=sampling,
+                      dispatcher=dispatcher,
+                      perf=perf,
+                      budget=budget,
+                      engine_options=engine_options)
         setattr(sys.modules[name], key, autotest(**kwargs)(func))
     # Find all classes
     for key, cls in classes:
@@ -188,6 +284,11 @@ def testall(max_tests=MAX_TESTS,
                               exit_on_error=exit_on_error,
                               logger=logger,
                               engines=engines,
-                              mclass=cls, mattr=attr)
+                              mclass=cls, mattr=attr,
+                              sampling=sampling,
+                              dispatcher=dispatcher,
+                              perf=perf,
+                              budget=budget,
+                              engine_options=engine_options)
                 setattr(cls,attr, autotest(**kwargs)(getattr(cls,attr)))
 
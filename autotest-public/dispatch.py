@@ -0,0 +1,204 @@
+import atexit
+import os
+import Queue
+import threading
+import traceback
+import unittest
+from loggers import DefaultLogger
+
+# Asynchronous dispatch of the autotest checks.
+# The instrumented function only snapshots its input and output and
+# enqueues them; background worker threads run the engines.
+
+# What to do when the queue is full.
+DROP_NEWEST = 'drop_newest' # Discards the check being submitted.
+DROP_OLDEST = 'drop_oldest' # Discards the oldest queued check.
+BLOCK = 'block' # Waits until there is room in the queue.
+
+class AsyncDispatcher(object):
+    """Runs checks on background worker threads.
+    One dispatcher can be shared by all the functions instrumented in a module."""
+
+    def __init__(self, maxsize=1000, num_workers=1, overflow=DROP_NEWEST,
+                 logger=DefaultLogger()):
+        if overflow not in (DROP_NEWEST, DROP_OLDEST, BLOCK):
+            raise ValueError("Unknown overflow policy %r" % overflow)
+        self.overflow = overflow
+        self.logger = logger
+        self.queue = Queue.Queue(maxsize)
+        # Number of checks discarded because the queue was full.
+        self.dropped = 0
+        self.workers = []
+        for i in range(num_workers):
+            t = threading.Thread(target=self._work, name='autotest-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+        # Runs the pending checks before the interpreter exits.
+        atexit.register(self.close)
+
+    def submit(self, f, *args):
+        """Queues the call f(*args).
+        With BLOCK, a check that a worker submits (when a check calls an
+        instrumented function) while the queue is full is run at once: the
+        worker would otherwise wait for room that only the workers make."""
+        if not self.workers:
+            # The dispatcher has been closed.
+            f(*args)
+            return
+        job = (f, args)
+        if self.overflow == BLOCK:
+            if threading.current_thread() not in self.workers:
+                self.queue.put(job)
+                return
+            try:
+                self.queue.put_nowait(job)
+            except Queue.Full:
+                f(*args)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(job)
+                return
+            except Queue.Full:
+                self.dropped += 1
+                if self.overflow == DROP_NEWEST:
+                    return
+            # Makes room by discarding the oldest job, and tries again.
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except Queue.Empty:
+                pass
+
+    def flush(self):
+        """Waits until all the queued checks have been run."""
+        self.queue.join()
+
+    def close(self):
+        """Runs the queued checks, and stops the workers."""
+        if not self.workers:
+            return
+        self.flush()
+        for t in self.workers:
+            self.queue.put(None)
+        for t in self.workers:
+            t.join()
+        self.workers = []
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            f, args = job
+            try:
+                f(*args)
+            except SystemExit, e:
+                # An engine asked to exit on error: sys.exit would only end
+                # this thread, so we end the process.
+                self.logger.write("autotest worker exiting on error")
+                os._exit(e.code if isinstance(e.code, int) else -1)
+            except Exception:
+                self.logger.write(traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+
+class _ListLogger(object):
+    def __init__(self):
+        self.lines = []
+
+    def write(self, s):
+        self.lines.append(s)
+
+class TestAsyncDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.done = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def block(self):
+        """Job that keeps the worker busy until self.release is set."""
+        self.started.set()
+        self.release.wait()
+
+    def busy_dispatcher(self, overflow, maxsize=2):
+        """Returns a dispatcher whose only worker is blocked."""
+        dispatcher = AsyncDispatcher(maxsize=maxsize, overflow=overflow, logger=_ListLogger())
+        self.addCleanup(dispatcher.close)
+        self.addCleanup(self.release.set)
+        dispatcher.submit(self.block)
+        self.started.wait()
+        return dispatcher
+
+    def test_drop_newest(self):
+        dispatcher = self.busy_dispatcher(DROP_NEWEST)
+        for i in range(4):
+            dispatcher.submit(self.done.append, i)
+        self.release.set()
+        dispatcher.flush()
+        self.assertEqual(self.done, [0, 1])
+        self.assertEqual(dispatcher.dropped, 2)
+
+    def test_drop_oldest(self):
+        dispatcher = self.busy_dispatcher(DROP_OLDEST)
+        for i in range(4):
+            dispatcher.submit(self.done.append, i)
+        self.release.set()
+        dispatcher.flush()
+        self.assertEqual(self.done, [2, 3])
+        self.assertEqual(dispatcher.dropped, 2)
+
+    def test_block(self):
+        dispatcher = self.busy_dispatcher(BLOCK)
+        dispatcher.submit(self.done.append, 0)
+        dispatcher.submit(self.done.append, 1)
+        t = threading.Thread(target=dispatcher.submit, args=(self.done.append, 2))
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        self.release.set()
+        t.join()
+        dispatcher.flush()
+        self.assertEqual(self.done, [0, 1, 2])
+        self.assertEqual(dispatcher.dropped, 0)
+
+    def test_block_from_worker(self):
+        dispatcher = AsyncDispatcher(maxsize=1, overflow=BLOCK, logger=_ListLogger())
+        self.addCleanup(dispatcher.close)
+        def job():
+            # The first check fills the queue, the second is run at once.
+            dispatcher.submit(self.done.append, 1)
+            dispatcher.submit(self.done.append, 2)
+        dispatcher.submit(job)
+        t = threading.Thread(target=dispatcher.flush)
+        t.daemon = True
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(self.done, [2, 1])
+
+    def test_close(self):
+        dispatcher = self.busy_dispatcher(DROP_NEWEST, maxsize=10)
+        for i in range(5):
+            dispatcher.submit(self.done.append, i)
+        self.release.set()
+        dispatcher.close()
+        self.assertEqual(self.done, range(5))
+        self.assertEqual(dispatcher.workers, [])
+        # Once closed, the checks run on the caller's thread.
+        dispatcher.submit(self.done.append, 5)
+        self.assertEqual(self.done, range(6))
+
+    def test_errors(self):
+        self.assertRaises(ValueError, AsyncDispatcher, overflow='drop_all')
+        dispatcher = AsyncDispatcher(logger=_ListLogger())
+        self.addCleanup(dispatcher.close)
+        dispatcher.submit(lambda: 1 / 0)
+        dispatcher.submit(self.done.append, 1)
+        dispatcher.flush()
+        self.assertEqual(self.done, [1])
+        self.assertTrue('ZeroDivisionError' in dispatcher.logger.lines[0])
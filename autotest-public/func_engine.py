@@ -5,13 +5,33 @@ import json
 import math
 import os
 import cPickle as pickle
+import shutil
 import hashlib
+import struct
 import sys
 import subprocess
+import tempfile
+import time
+import unittest
 from loggers import DefaultLogger
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # This engine checks the functional invariance of the code behavior.
 
+# Limits on the objects whose canonical hash we compute: nesting depth,
+# and size in bytes of the encoding.
+MAX_HASH_DEPTH = 100
+MAX_HASH_SIZE = 1 << 26
+
 def serialize(obj):
     """
     given an obj(ect) returns a string s such that eval(s) == obj
@@ -30,6 +50,168 @@ def serialize(obj):
         raise Exception #unable to serialize
 
 
+class _HashWriter(object):
+    """Buffers the canonical encoding of an object, and feeds it to a hash."""
+
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, h, max_size):
+        self.h = h
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = []
+        self.buffered = 0
+
+    def write(self, s):
+        self.chunks.append(s)
+        self.buffered += len(s)
+        if self.buffered >= self.BUFFER_SIZE:
+            self.flush()
+
+    def write_buffer(self, b, n):
+        """Writes an object supporting the buffer protocol, of n bytes, without copying it."""
+        self.flush()
+        self.size += n
+        if self.size > self.max_size:
+            raise ValueError("object too large to hash")
+        self.h.update(b)
+
+    def remaining(self):
+        """Returns how many more bytes can be written."""
+        return self.max_size - self.size - self.buffered
+
+    def flush(self):
+        self.size += self.buffered
+        if self.size > self.max_size:
+            raise ValueError("object too large to hash")
+        self.h.update(''.join(self.chunks))
+        self.chunks = []
+        self.buffered = 0
+
+
+class _StringWriter(object):
+    """Collects the canonical encoding of an object in a string of at most max_size bytes."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = []
+
+    def write(self, s):
+        self.size += len(s)
+        if self.size > self.max_size:
+            raise ValueError("object too large to hash")
+        self.chunks.append(s)
+
+    def write_buffer(self, b, n):
+        self.size += n
+        if self.size > self.max_size:
+            raise ValueError("object too large to hash")
+        self.chunks.append(str(b))
+
+    def remaining(self):
+        return self.max_size - self.size
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+def _encode_sorted(items, out, depth, max_depth):
+    """Encodes a collection whose order does not matter, by sorting the encodings of its items."""
+    encoded = []
+    # The items are encoded within what remains of the size limit.
+    budget = out.remaining()
+    for item in items:
+        w = _StringWriter(budget)
+        _encode(item, w, depth, max_depth)
+        encoded.append(w.getvalue())
+        budget -= w.size
+    encoded.sort()
+    out.write(struct.pack('<Q', len(encoded)))
+    for s in encoded:
+        out.write(s)
+
+
+def _encode(obj, out, depth, max_depth):
+    """Writes to out a deterministic encoding of obj, made of a one-letter tag
+    followed by the content."""
+    if depth > max_depth:
+        raise ValueError("object too deep to hash")
+    depth += 1
+    t = type(obj)
+    if obj is None:
+        out.write('N')
+    elif t is bool:
+        out.write('T' if obj else 'F')
+    elif isinstance(obj, (int, long)):
+        s = str(int(obj))
+        out.write('i%d:%s' % (len(s), s))
+    elif isinstance(obj, float):
+        out.write('f' + struct.pack('<d', obj))
+    elif isinstance(obj, complex):
+        out.write('c' + struct.pack('<dd', obj.real, obj.imag))
+    elif isinstance(obj, str):
+        out.write('s' + struct.pack('<Q', len(obj)))
+        out.write(obj)
+    elif isinstance(obj, unicode):
+        s = obj.encode('utf-8')
+        out.write('u' + struct.pack('<Q', len(s)))
+        out.write(s)
+    elif isinstance(obj, tuple):
+        out.write('t' + struct.pack('<Q', len(obj)))
+        for x in obj:
+            _encode(x, out, depth, max_depth)
+    elif isinstance(obj, list):
+        out.write('l' + struct.pack('<Q', len(obj)))
+        for x in obj:
+            _encode(x, out, depth, max_depth)
+    elif isinstance(obj, dict):
+        out.write('d')
+        _encode_sorted(obj.iteritems(), out, depth, max_depth)
+    elif isinstance(obj, (set, frozenset)):
+        out.write('S')
+        _encode_sorted(obj, out, depth, max_depth)
+    elif numpy is not None and isinstance(obj, numpy.ndarray):
+        if obj.dtype.hasobject:
+            raise TypeError("cannot hash object arrays")
+        a = numpy.ascontiguousarray(obj)
+        header = '%s%r' % (a.dtype.str, a.shape)
+        out.write('a%d:%s' % (len(header), header))
+        out.write_buffer(a.data, a.nbytes)
+    elif hasattr(obj, '__dict__'):
+        name = '%s.%s' % (t.__module__, t.__name__)
+        out.write('o%d:%s' % (len(name), name))
+        _encode(obj.__dict__, out, depth, max_depth)
+    else:
+        # Other objects, such as dates, decimals and numpy scalars, are
+        # encoded by their serialization, as the tests store them.
+        try:
+            serial = serialize(obj)
+        except Exception:
+            raise TypeError("cannot hash %r" % t)
+        name = '%s.%s' % (t.__module__, t.__name__)
+        out.write('r%d:%s' % (len(name), name) + struct.pack('<Q', len(serial)))
+        out.write(serial)
+
+
+def canonical_hash(obj, max_depth=MAX_HASH_DEPTH, max_size=MAX_HASH_SIZE):
+    """
+    returns the md5 hex digest of a canonical encoding of obj, an object
+    made of numbers, strings, tuples, lists, dicts, sets, numpy arrays and
+    objects with a __dict__; other objects are encoded by serialize.
+    equal objects have the same hash if their parts have the same types:
+    1 and 1.0, or [1] and (1, ), do not.
+    raises TypeError for objects that cannot be serialized, and ValueError
+    if obj is nested more than max_depth levels or its encoding exceeds
+    max_size bytes
+    """
+    h = hashlib.md5()
+    out = _HashWriter(h, max_size)
+    _encode(obj, out, 0, max_depth)
+    out.flush()
+    return h.hexdigest()
+
+
 def prep(name):
     """
     converts 'one.two.three' in 'OneTwoThree'
@@ -38,6 +220,224 @@ def prep(name):
     return ''.join(x.capitalize() for x in name.split('.'))
 
 
+def save_test(test_filename, module, name_obj, name_method, fname, serial_input, serial_output, cls=False):
+    """Saves a test, to be able to run it later."""
+    dr = test_filename.rsplit(os.sep, 1)[0]
+    if not os.path.exists(dr):
+        os.makedirs(dr)
+    with open(test_filename,'w') as test_file:
+        w = test_file.write
+        w('import unittest\n')
+        w('import cPickle as pickle\n')
+        w('import sys; sys.path.append(%s)\n' % repr(os.getcwd()))
+        w('from %s import %s\n' % (module, name_obj))
+        w('\n')
+        w('INPUT = %s\n' % serial_input)
+        w('\n')
+        w('OUTPUT = %s\n' % serial_output)
+        w('\n')
+        w('class Test%sFunctions(unittest.TestCase):\n' % prep(module))
+        w('    def test_%s(self):\n' % fname)
+        w('        args, kwargs = INPUT\n')
+        w('        func = %s\n' % name_method)
+        w('        c = func(*args, **kwargs)\n')
+        if cls:
+            w('        obj = args[0]\n')
+            w('        self.assertEqual(c,OUTPUT[0])\n')
+            w('        self.assertEqual(obj.__dict__, OUTPUT[1])\n')
+        else:
+            w('        self.assertEqual(c,OUTPUT[0])\n')
+        w('\n')
+        w('if __name__ == "__main__": unittest.main()')
+
+
+def load_test(test_filename):
+    """Returns the INPUT and OUTPUT of a test file written by save_test."""
+    module_name = 'tmp_'+test_filename.split(os.sep)[-1].rstrip('.py')
+    foo = imp.load_source(module_name, test_filename)
+    del sys.modules[module_name]
+    return foo.INPUT, foo.OUTPUT
+
+
+class PyFileCaseStore(object):
+    """
+    Stores each test case of a function in its own unittest file
+    "path/to/autotests/filename_<class>_<func>_<hash>.py"
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.prefix = engine.base_name + '_' + engine.flat_function_name + '_'
+
+    def load(self):
+        """Yields the input hash, name and expected output of each stored case."""
+        for test_filename in glob.glob(self.prefix + '*.py'):
+            file_hash = test_filename[len(self.prefix):-len('.py')]
+            # Skips the tests of other functions whose name starts with ours.
+            if len(file_hash) == 32 and '_' not in file_hash:
+                test_input, test_output = load_test(test_filename)
+                # We hash the input again, as older tests are named
+                # after the md5 of its repr.
+                try:
+                    yield canonical_hash(test_input), test_filename, test_output
+                except (TypeError, ValueError):
+                    pass
+
+    def add(self, input_hash, serial_input, serial_output):
+        """Stores a case, and returns its name."""
+        e = self.engine
+        test_filename = self.prefix + input_hash + '.py'
+        save_test(test_filename, e.module, e.class_name, e.qualified_function_name,
+                  e.flat_function_name, serial_input, serial_output, e.mclass)
+        return test_filename
+
+
+# Header of each record of a .cases file: input hash, and lengths of
+# the serialized input and output that follow.
+RECORD_HEADER = struct.Struct('<32sII')
+
+
+class PackedCaseStore(object):
+    """
+    Stores all the test cases of a function in a single file
+    "path/to/autotests/filename_<class>_<func>.cases"
+    made of a line of json describing the function, followed by one record
+    per case: a RECORD_HEADER, the serialized input, and the serialized output.
+    Cases can be read back by hash, and export_tests regenerates the
+    unittest files.
+    Several processes can add cases to the same file: each record is
+    appended with a single write, under an flock of the file (where fcntl
+    is available; otherwise, only one process may use the file).
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.filename = engine.base_name + '_' + engine.flat_function_name + '.cases'
+        # Position of each case in the file, by input hash.
+        self.offsets = {}
+        # Size of the file after our last write, if any.
+        self._end = None
+
+    def load(self):
+        """Yields the input hash, name and expected output of each stored case."""
+        if not os.path.exists(self.filename):
+            return
+        for input_hash, offset, serial_input, serial_output in read_cases(self.filename):
+            self.offsets[input_hash] = offset
+            yield input_hash, '%s:%s' % (self.filename, input_hash), eval(serial_output)
+
+    def get(self, input_hash):
+        """Returns the serialized input and output of a case."""
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offsets[input_hash])
+            _, input_len, output_len = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+            return f.read(input_len), f.read(output_len)
+
+    def add(self, input_hash, serial_input, serial_output):
+        """Stores a case, and returns its name."""
+        e = self.engine
+        dr = self.filename.rsplit(os.sep, 1)[0]
+        if not os.path.exists(dr):
+            os.makedirs(dr)
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            if size != self._end:
+                # Removes a record truncated by a crash, which would hide the
+                # cases added after it; the file is complete up to our last write.
+                start = self._end if self._end is not None and self._end < size else None
+                end = complete_size(self.filename, start)
+                if end < size:
+                    os.ftruncate(fd, end)
+                    size = end
+            if size == 0:
+                header = json.dumps(dict(module=e.module,
+                                         class_name=e.class_name,
+                                         qualified_function_name=e.qualified_function_name,
+                                         flat_function_name=e.flat_function_name,
+                                         is_method=bool(e.mclass))) + '\n'
+                _write_all(fd, header)
+                size = len(header)
+            record = (RECORD_HEADER.pack(input_hash, len(serial_input), len(serial_output)) +
+                      serial_input + serial_output)
+            _write_all(fd, record)
+            self.offsets[input_hash] = size
+            self._end = size + len(record)
+        finally:
+            # Also releases the lock.
+            os.close(fd)
+        return '%s:%s' % (self.filename, input_hash)
+
+
+def read_cases_header(filename):
+    """Returns the description of the function whose cases are stored in a .cases file."""
+    with open(filename, 'rb') as f:
+        return json.loads(f.readline())
+
+
+def read_cases(filename):
+    """Yields the input hash, offset, serialized input and serialized output
+    of each case stored in a .cases file."""
+    with open(filename, 'rb') as f:
+        f.readline()
+        while True:
+            offset = f.tell()
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # End of file, or a record truncated by a crash.
+                return
+            input_hash, input_len, output_len = RECORD_HEADER.unpack(header)
+            serial_input = f.read(input_len)
+            serial_output = f.read(output_len)
+            if len(serial_output) < output_len:
+                return
+            yield input_hash, offset, serial_input, serial_output
+
+
+def _write_all(fd, s):
+    while s:
+        s = s[os.write(fd, s):]
+
+
+def complete_size(filename, start=None):
+    """Returns the size of the part of a .cases file made of its header and
+    complete records, which is less than the size of the file if a crash
+    left a record truncated.  If start is given, the file is known to be
+    complete up to start."""
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        if start is not None:
+            end = start
+        elif not f.readline().endswith('\n'):
+            return 0
+        else:
+            end = f.tell()
+        while end + RECORD_HEADER.size <= size:
+            f.seek(end)
+            _, input_len, output_len = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+            record_end = end + RECORD_HEADER.size + input_len + output_len
+            if record_end > size:
+                break
+            end = record_end
+        return end
+
+
+def export_tests(filename):
+    """Writes the unittest file of each case stored in a .cases file,
+    and returns the list of the files written."""
+    h = read_cases_header(filename)
+    prefix = filename[:-len('.cases')] + '_'
+    test_filenames = []
+    for input_hash, _, serial_input, serial_output in read_cases(filename):
+        test_filename = prefix + input_hash + '.py'
+        save_test(test_filename, h['module'], h['class_name'], h['qualified_function_name'],
+                  h['flat_function_name'], serial_input, serial_output, h['is_method'])
+        test_filenames.append(test_filename)
+    return test_filenames
+
+
 class FuncEngine(autotest.ExampleEngine):
     """
         - if func is a regular function:
@@ -64,8 +464,12 @@ class FuncEngine(autotest.ExampleEngine):
         In case the test fails it also logs an error message to stderr and,
         if exit_on_error=True (default) it sys.exit(-1)
 
+        The test cases are kept by an instance of case_store_class.
+
     """
 
+    case_store_class = PyFileCaseStore
+
     def __init__(self,
                  mfunc=None,
                  mclass=None,
@@ -79,7 +483,8 @@ class FuncEngine(autotest.ExampleEngine):
                  class_name='class',
                  flat_function_name='flat_function',
                  qualified_function_name='qual_name',
-                 switches=None):
+                 switches=None,
+                 overhead=None):
         self.mfunc = mfunc
         self.mclass = mclass
         self.mattr = mattr
@@ -93,76 +498,248 @@ class FuncEngine(autotest.ExampleEngine):
         self.flat_function_name = flat_function_name
         self.qualified_function_name = qualified_function_name
         self.switches = switches or {}
+        # Overhead counters of the function (see the overhead module).
+        self.overhead = overhead
         # How many tests have we already generated?
         self.test_counter = 0
         # Have we already checked all tests?
         self.has_run_tests = False
+        # Where the tests are stored.
+        self.case_store = self.case_store_class(self)
+        # Name and expected output of the existing tests, by input hash; read on first use.
+        self._index = None
 
     def test(self, input, output):
         return
 
-    def learn(self, input, output):
+    def learn(self, input, output, perf=None):
         if self.test_counter >= self.max_tests:
             # We have learned (created tests) as much as it is possible.
             return
-        # Tries to serialize the input and output; does nothing if this does not work.
+        # Tries to hash the input; does nothing if this does not work.
         try:
-            serial_input = serialize(input)
-            serial_output = serialize(output)
-        except:
+            input_hash = canonical_hash(input)
+        except (TypeError, ValueError):
             return
-        # hash the serialized input
-        input_hash = hashlib.md5(serial_input).hexdigest()
-        # if the filename is "path/to/filename.py" name_parts becomes ["path/to","autotest","filename"]
-        # this is the filename associate to this autotest the name is generated as
-        # "path/to/autotests/filename_<class>_<func>_<hash>.py"
-        # This contains a test.  The test contains the serialization of the input and output.
-        test_filename = self.base_name + '_' + self.flat_function_name + '_' + input_hash +'.py'
-        test_exists = os.path.exists(test_filename)
-        if test_exists:
-            self.run_single_test(test_filename, output)
-        if not test_exists and (self.test_counter < self.max_tests or self.max_tests is None):
+        index = self._get_index()
+        if input_hash in index:
+            test_name, expected_output = index[input_hash]
+            self.run_single_test(test_name, expected_output, output)
+        elif self.test_counter < self.max_tests or self.max_tests is None:
+            # Tries to serialize the input and output; does nothing if this does not work.
+            try:
+                serial_input = serialize(input)
+                serial_output = serialize(output)
+            except:
+                return
             # We need to generate the test.
             self.test_counter += 1
-            self._save_test(test_filename, self.module, self.class_name, self.qualified_function_name,
-                           self.flat_function_name, serial_input, serial_output, self.mclass)
-
-    def run_single_test(self, test_filename, output):
-        module_name = 'tmp_'+test_filename.split(os.sep)[-1].rstrip('.py')
-        foo = imp.load_source(module_name, test_filename)
-        del sys.modules[module_name]
-        if foo.OUTPUT != output and not self.qualified_function_name in self.switches:
-            print 'test %s failed' % test_filename
+            start = time.time()
+            test_name = self.case_store.add(input_hash, serial_input, serial_output)
+            if self.overhead is not None:
+                self.overhead.add('persist', start)
+            index[input_hash] = (test_name, eval(serial_output))
+
+    def _get_index(self):
+        """Returns the dictionary mapping the canonical hash of the input of
+        each existing test to its name and expected output, reading the
+        tests the first time."""
+        if self._index is None:
+            self._index = {}
+            for input_hash, test_name, test_output in self.case_store.load():
+                self._index[input_hash] = (test_name, test_output)
+        return self._index
+
+    def run_single_test(self, test_name, expected_output, output):
+        if expected_output != output and not self.qualified_function_name in self.switches:
+            print 'test %s failed' % test_name
             if self.exit_on_error:
                 sys.exit(-1)
 
-    def _save_test(self, test_filename, module, name_obj, name_method, fname, serial_input, serial_output, cls=False):
-        """Saves a test, to be able to run it later."""
-        dr = test_filename.rsplit(os.sep, 1)[0]
-        if not os.path.exists(dr):
-            os.makedirs(dr)
-        with open(test_filename,'w') as test_file:
-            w = test_file.write
-            w('import unittest\n')
-            w('import cPickle as pickle\n')
-            w('import sys; sys.path.append(%s)\n' % repr(os.getcwd()))
-            w('from %s import %s\n' % (module, name_obj))
-            w('\n')
-            w('INPUT = %s\n' % serial_input)
-            w('\n')
-            w('OUTPUT = %s\n' % serial_output)
-            w('\n')
-            w('class Test%sFunctions(unittest.TestCase):\n' % prep(module))
-            w('    def test_%s(self):\n' % fname)
-            w('        args, kwargs = INPUT\n')
-            w('        func = %s\n' % name_method)
-            w('        c = func(*args, **kwargs)\n')
-            if cls:
-                w('        obj = args[0]\n')
-                w('        self.assertEqual(c,OUTPUT[0])\n')
-                w('        self.assertEqual(obj.__dict__, OUTPUT[1])\n')
-            else:
-                w('        self.assertEqual(c,OUTPUT[0])\n')
-            w('\n')
-            w('if __name__ == "__main__": unittest.main()')
 
+class PackedFuncEngine(FuncEngine):
+    """FuncEngine keeping all the test cases of a function in one .cases file."""
+
+    case_store_class = PackedCaseStore
+
+
+class TestCanonicalHash(unittest.TestCase):
+
+    def test_deterministic(self):
+        a = {'x': [1, 2.5, u'u', None], 'y': set(['a', 'b', 'c']), 'z': (True, 3j)}
+        self.assertEqual(canonical_hash(a), canonical_hash(a))
+        # The same dict and set, built in another order.
+        b = {}
+        for k in ('z', 'y', 'x'):
+            b[k] = a[k]
+        b['y'] = set(['c', 'a']) | set(['b'])
+        self.assertEqual(canonical_hash(a), canonical_hash(b))
+        keys = ['k%d' % i for i in range(1000)]
+        self.assertEqual(canonical_hash(dict.fromkeys(keys, 1)),
+                         canonical_hash(dict.fromkeys(reversed(keys), 1)))
+        self.assertEqual(canonical_hash(frozenset(keys)), canonical_hash(frozenset(reversed(keys))))
+
+    def test_types(self):
+        values = [1, 1L, 1.0, True, '1', u'1', [1], (1, ), set([1]), {1: 1}, None, 1j]
+        hashes = set(canonical_hash(v) for v in values)
+        # 1 and 1L are the same int.
+        self.assertEqual(len(hashes), len(values) - 1)
+        self.assertNotEqual(canonical_hash(['ab', 'c']), canonical_hash(['a', 'bc']))
+        if numpy is not None:
+            a = numpy.arange(6)
+            self.assertEqual(canonical_hash(a), canonical_hash(numpy.arange(6)))
+            self.assertNotEqual(canonical_hash(a), canonical_hash(a.reshape(2, 3)))
+            self.assertNotEqual(canonical_hash(a), canonical_hash(a.astype(float)))
+
+    def test_limits(self):
+        deep = []
+        for i in range(10):
+            deep = [deep]
+        self.assertEqual(len(canonical_hash(deep, max_depth=10)), 32)
+        self.assertRaises(ValueError, canonical_hash, deep, max_depth=9)
+        self.assertRaises(ValueError, canonical_hash, 'x' * 100, max_size=50)
+        self.assertRaises(ValueError, canonical_hash, {'k': 'x' * 100}, max_size=50)
+        self.assertRaises(ValueError, canonical_hash, set(['x' * 30, 'y' * 30]), max_size=50)
+
+    def test_fallback(self):
+        import datetime, decimal, threading
+        d = datetime.date(2020, 1, 1)
+        self.assertEqual(canonical_hash(d), canonical_hash(datetime.date(2020, 1, 1)))
+        self.assertNotEqual(canonical_hash(d), canonical_hash(datetime.date(2020, 1, 2)))
+        self.assertNotEqual(canonical_hash(decimal.Decimal('1.5')), canonical_hash(1.5))
+        if numpy is not None:
+            for v in (numpy.float32(1.5), numpy.int32(3), numpy.bool_(True)):
+                self.assertEqual(canonical_hash(v), canonical_hash(v.copy()))
+            self.assertNotEqual(canonical_hash(numpy.float32(1.5)), canonical_hash(1.5))
+        self.assertRaises(TypeError, canonical_hash, threading.Lock())
+
+    def test_learn(self):
+        import datetime
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        engine = PackedFuncEngine(module='m', base_name=os.path.join(dirname, 'm'), max_tests=10,
+                                  class_name='f', flat_function_name='f', qualified_function_name='f')
+        d = datetime.date(2020, 1, 1)
+        engine.learn(((d, 3), {}), (d + datetime.timedelta(3), None))
+        self.assertEqual(engine.test_counter, 1)
+        self.assertEqual(len(list(PackedCaseStore(engine).load())), 1)
+
+
+class TestFuncEngine(unittest.TestCase):
+
+    def make_engine(self, case_store_class=PyFileCaseStore):
+        engine = FuncEngine(module=self.module, base_name=os.path.join(self.dirname, self.module),
+                            max_tests=10, class_name='f', flat_function_name='f',
+                            qualified_function_name='f')
+        engine.case_store = case_store_class(engine)
+        loads = []
+        load = engine.case_store.load
+        def counted_load():
+            loads.append(1)
+            return load()
+        engine.case_store.load = counted_load
+        return engine, loads
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dirname)
+        # The unittest files import the function from its module.
+        self.module = 'func_engine_test_%d' % os.getpid()
+        with open(os.path.join(self.dirname, self.module + '.py'), 'w') as f:
+            f.write('def f(x):\n    return 2 * x\n')
+        sys.path.insert(0, self.dirname)
+        self.addCleanup(sys.path.remove, self.dirname)
+
+    def test_index(self):
+        for case_store_class in (PyFileCaseStore, PackedCaseStore):
+            engine, loads = self.make_engine(case_store_class)
+            engine.learn(((1, ), {}), (2, None))
+            engine.learn(((2, ), {}), (4, None))
+            # The cases are read once, and the new ones are added to the index.
+            self.assertEqual(len(loads), 1)
+            self.assertEqual(engine.test_counter, 2)
+            self.assertEqual(sorted(v[1] for v in engine._get_index().values()), [(2, None), (4, None)])
+            engine.learn(((1, ), {}), (2, None))
+            self.assertEqual((len(loads), engine.test_counter), (1, 2))
+            self.assertRaises(SystemExit, engine.learn, ((2, ), {}), (5, None))
+            # Another engine finds the stored cases.
+            engine, loads = self.make_engine(case_store_class)
+            engine.learn(((2, ), {}), (4, None))
+            self.assertEqual((len(loads), engine.test_counter), (1, 0))
+            self.assertRaises(SystemExit, engine.learn, ((1, ), {}), (3, None))
+            engine.learn(((3, ), {}), (6, None))
+            self.assertEqual(len(engine._get_index()), 3)
+
+    def test_max_tests(self):
+        engine, loads = self.make_engine()
+        for i in range(20):
+            engine.learn(((i, ), {}), (2 * i, None))
+        self.assertEqual(engine.test_counter, 10)
+        self.assertEqual(len(engine._get_index()), 10)
+        self.assertEqual(len(list(PyFileCaseStore(engine).load())), 10)
+
+
+class TestPackedCaseStore(unittest.TestCase):
+
+    def setUp(self):
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        self.engine = FuncEngine(module='m', base_name=os.path.join(dirname, 'autotests', 'm'),
+                                 class_name='f', flat_function_name='f', qualified_function_name='f')
+
+    def test_add(self):
+        store = PackedCaseStore(self.engine)
+        store.add('a' * 32, '((1, ), {})', '(2, None)')
+        store.add('b' * 32, '((2, ), {})', '(4, None)')
+        store = PackedCaseStore(self.engine)
+        self.assertEqual([(h, out) for h, name, out in store.load()],
+                         [('a' * 32, (2, None)), ('b' * 32, (4, None))])
+        self.assertEqual(store.get('b' * 32), ('((2, ), {})', '(4, None)'))
+
+    def test_processes(self):
+        children = []
+        for c in range(4):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    store = PackedCaseStore(self.engine)
+                    for i in range(50):
+                        store.add('%d%031d' % (c, i), '((%d, ), {})' % i, repr((c, 'x' * i)))
+                    status = 0
+                finally:
+                    os._exit(status)
+            children.append(pid)
+        for pid in children:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        store = PackedCaseStore(self.engine)
+        cases = dict((h, out) for h, name, out in store.load())
+        self.assertEqual(len(cases), 200)
+        self.assertEqual(cases['%d%031d' % (3, 7)], (3, 'x' * 7))
+        self.assertEqual(store.get('%d%031d' % (2, 49)), ('((49, ), {})', repr((2, 'x' * 49))))
+        self.assertEqual(read_cases_header(store.filename)['module'], 'm')
+
+    def test_truncated(self):
+        store = PackedCaseStore(self.engine)
+        store.add('a' * 32, '((1, ), {})', '(2, None)')
+        store.add('b' * 32, '((2, ), {})', '(4, None)')
+        # A crash in the middle of writing the second record.
+        with open(store.filename, 'r+b') as f:
+            f.truncate(os.path.getsize(store.filename) - 3)
+        store = PackedCaseStore(self.engine)
+        self.assertEqual([h for h, name, out in store.load()], ['a' * 32])
+        store.add('c' * 32, '((3, ), {})', '(6, None)')
+        store = PackedCaseStore(self.engine)
+        self.assertEqual([(h, out) for h, name, out in store.load()],
+                         [('a' * 32, (2, None)), ('c' * 32, (6, None))])
+        self.assertEqual(store.get('c' * 32), ('((3, ), {})', '(6, None)'))
+
+
+if __name__ == '__main__':
+    # python func_engine.py export path/to/autotests/filename_<class>_<func>.cases ...
+    if len(sys.argv) > 2 and sys.argv[1] == 'export':
+        for filename in sys.argv[2:]:
+            for test_filename in export_tests(filename):
+                print test_filename
+    else:
+        print 'usage: python func_engine.py export <file.cases> ...'
@@ -5,8 +5,13 @@
 import base64
 import datetime
 import importlib
+import io
 import json
+import mmap
 import numpy
+import shutil
+import struct
+import tempfile
 import unittest
 
 # TODO: fix this.
@@ -16,16 +21,162 @@ class Storage(dict):
     __getattr__ = dict.__getitem__
     __setattr__ = dict.__setitem__
 
+# Blobs of arrays written to a side file start at multiples of BLOB_ALIGNMENT bytes.
+BLOB_ALIGNMENT = 16
+
+# A container is a json document followed by a binary section holding the
+# data of its arrays, and by a footer with the offset of the section.
+CONTAINER_FOOTER = struct.Struct('<Q8s')
+CONTAINER_MAGIC = 'JSONPLUS'
+
+# Classes of the decoded objects, by module and class name.
+_class_cache = {}
+
+def _get_class(meta_module, meta_class):
+    cls = _class_cache.get((meta_module, meta_class))
+    if cls is None:
+        module = importlib.import_module(meta_module)
+        cls = _class_cache[(meta_module, meta_class)] = getattr(module, meta_class)
+    return cls
+
+def _write_blob(blobs, a):
+    """Writes the raw data of array a to the file blobs, and returns its offset."""
+    offset = blobs.tell()
+    padding = -offset % BLOB_ALIGNMENT
+    if padding:
+        blobs.write('\0' * padding)
+        offset += padding
+    blobs.write(numpy.ascontiguousarray(a).data)
+    return offset
+
+def _read_blob(blobs, offset, dtype, shape):
+    """Reads an array from the file blobs, directly into a new writable array."""
+    v = numpy.empty(shape, dtype=dtype)
+    blobs.seek(offset)
+    if v.nbytes and blobs.readinto(v) != v.nbytes:
+        raise ValueError("Truncated array blob at offset %d" % offset)
+    return v
+
+def _view_blob(buf, base, writable):
+    """Returns a function returning the arrays of a container as views over
+    the buffer buf, whose binary section starts at base.  The views are
+    read-only, unless writable is True and buf is writable."""
+    def view(offset, dtype, shape):
+        dtype = numpy.dtype(dtype)
+        count = int(numpy.prod(shape))
+        v = numpy.frombuffer(buf, dtype=dtype, count=count, offset=base + offset)
+        if not writable:
+            v.setflags(write=False)
+        return v.reshape(shape)
+    return view
+
+def is_container(s):
+    """Returns True if the string or buffer s is a container."""
+    return len(s) >= CONTAINER_FOOTER.size and s[-len(CONTAINER_MAGIC):] == CONTAINER_MAGIC
+
+def _encoder(pack_ndarray=False, tolerant=True, blobs=None):
+    """Returns the default function of the json encoder.  If blobs is a
+    file, numpy arrays are written to it, and encoded by their offset."""
+    def custom(o):
+        if isinstance(o, Serializable):
+            d = {'meta_class': '%s.%s' % (o.__class__.__module__,
+                                          o.__class__.__name__)}
+            d.update(item for item in o.__dict__.items() if not item[0].startswith('_'))
+            return d
+        elif isinstance(o, datetime.datetime):
+            return {'meta_class': 'datetime.datetime', 'date': o.isoformat()}
+        elif isinstance(o, set):
+            return {'meta_class': 'set', 'set': list(o)}
+        elif type(o) == numpy.float:
+            return float(o)
+        elif type(o) == numpy.bool:
+            return bool(o)
+        elif isinstance(o, (numpy.int, numpy.int16, numpy.int32, numpy.int64, numpy.int8)):
+            return int(o)
+        elif type(o).__module__ == numpy.__name__:
+            if pack_ndarray and isinstance(o, numpy.ndarray):
+                d = {'meta_class': '%s.ndarray' % numpy.__name__,
+                     'dtype': str(o.dtype),
+                     'shape': o.shape}
+                if blobs is not None:
+                    d['blob'] = _write_blob(blobs, o)
+                else:
+                    d['data'] = base64.b64encode(o.tostring())
+                return d
+            else:
+                return '<numpy %r>' % (o.shape, )
+        elif isinstance(o, (int, long, str, unicode, float, bool, list, tuple, dict)):
+            return o
+        elif tolerant:
+            return None
+        else:
+            raise ValueError("Cannot encode in json object %r" % o)
+    return custom
+
+def _decoder(objectify=True, remapper={}, fallback={}, read_blob=None):
+    """Returns the object hook of the json decoder.  read_blob(offset,
+    dtype, shape) returns the arrays encoded by offset."""
+    def hook(o):
+        meta_module, meta_class = None, o.get('meta_class')
+        if meta_class is None:
+            return Storage(o)
+        if meta_class == 'datetime.datetime':
+            try:
+                tmp = datetime.datetime.strptime(
+                    o['date'], '%Y-%m-%dT%H:%M:%S.%f')
+            except Exception, e:
+                tmp = datetime.datetime.strptime(
+                    o['date'], '%Y-%m-%dT%H:%M:%S')
+            return tmp
+        elif meta_class == 'set':
+            return set(o['set'])
+        elif meta_class == '%s.ndarray' % numpy.__name__:
+            dtype = o['dtype']
+            shape = o['shape']
+            if 'blob' in o:
+                if read_blob is None:
+                    raise ValueError("Array blob found, but no blob file given")
+                return read_blob(o['blob'], dtype, shape)
+            data = base64.b64decode(o['data'])
+            v = numpy.frombuffer(data, dtype=dtype)
+            v = v.reshape(shape)
+            try:
+                v.setflags(write=True)
+            except ValueError:
+                # Recent numpy versions refuse to make a view of an
+                # immutable string writable.
+                v = v.copy()
+            return v
+
+        elif '.' in meta_class:
+            # correct for classes that have migrated from one module to another
+            meta_class = remapper.get(meta_class, meta_class)
+            # separate the module name from the actual class name
+            meta_module, meta_class = meta_class.rsplit('.',1)
+
+        del o['meta_class']
+        # this option is for backward compatibility, in case classes
+        # change the module where they can be found.
+        if meta_class in fallback:
+            meta_module = fallback.get(meta_class)
+
+        if meta_module is not None and objectify:
+            obj = _get_class(meta_module, meta_class)()
+            obj.__dict__.update(o)
+            o = obj
+        return o
+    return hook
+
 class Serializable(object):
 
     def __eq__(self, other):
         return self.__dict__ == other.__dict__
 
-    def to_json(self, pack_ndarray=False, tolerant=True):
-        return Serializable.dumps(self, pack_ndarray=pack_ndarray, tolerant=tolerant)
+    def to_json(self, pack_ndarray=False, tolerant=True, indent=None):
+        return Serializable.dumps(self, pack_ndarray=pack_ndarray, tolerant=tolerant, indent=indent)
 
     @staticmethod
-    def dumps(obj, pack_ndarray=False, tolerant=True):
+    def dumps(obj, pack_ndarray=False, tolerant=True, indent=None):
         """This function dumps an object to extended json. 
         All objects that are json-serializable data types, and in addition,
         numpy float, bool, or int types are serialized. 
@@ -38,41 +189,41 @@ class Serializable(object):
         ValueError will be raised when non-serializable attributes are found.
         Setting tolerant=True can be used for conditionally serializing only
         portions of an object.
+        indent is passed to json; set it to 2 for readable output.
         
         """ 
-        def custom(o):
-            if isinstance(o, Serializable):
-                module = o.__class__.__module__.split('campil.')[-1]
-                d = {'meta_class': '%s.%s' % (o.__class__.__module__,
-                                              o.__class__.__name__)}
-                d.update(item for item in o.__dict__.items() if not item[0].startswith('_'))
-                return d
-            elif isinstance(o, datetime.datetime):
-                return {'meta_class': 'datetime.datetime', 'date': o.isoformat()}
-            elif isinstance(o, set):
-                return {'meta_class': 'set', 'set': list(o)}
-            elif type(o) == numpy.float:
-                return float(o)
-            elif type(o) == numpy.bool:
-                return bool(o)
-            elif isinstance(o, (numpy.int, numpy.int16, numpy.int32, numpy.int64, numpy.int8)):
-                return int(o)
-            elif type(o).__module__ == numpy.__name__:
-                if pack_ndarray and isinstance(o, numpy.ndarray):
-                    d = {'meta_class': '%s.ndarray' % numpy.__name__,
-                         'dtype': str(o.dtype),
-                         'shape': o.shape,
-                         'data': base64.b64encode(o.tostring())}
-                    return d
-                else:
-                    return '<numpy %r>' % (o.shape, )
-            elif isinstance(o, (int, long, str, unicode, float, bool, list, tuple, dict)):
-                return o
-            elif tolerant:
-                return None
-            else:
-                raise ValueError("Cannot encode in json object %r" % o)
-        return json.dumps(obj, default=custom, indent=2)
+        return json.dumps(obj, default=_encoder(pack_ndarray, tolerant), indent=indent)
+
+    @staticmethod
+    def dump(obj, fileobj, pack_ndarray=False, tolerant=True, indent=None, blobs=None):
+        """Like dumps, but writes the json to fileobj as it is encoded,
+        without building the whole document in memory.
+        If blobs is a binary file, and pack_ndarray is True, the data of
+        the numpy arrays are written raw to blobs, rather than in base64
+        in the json, which then refers to them by offset.
+        """
+        custom = _encoder(pack_ndarray, tolerant, blobs)
+        if indent is not None:
+            encoder = json.JSONEncoder(default=custom, indent=indent)
+            for chunk in encoder.iterencode(obj):
+                fileobj.write(chunk)
+            return
+        # Serializable objects are written one attribute at a time, and the
+        # attributes encoded in one shot, which uses the fast C encoder.
+        encoder = json.JSONEncoder(default=custom)
+        def write(o):
+            if not isinstance(o, Serializable):
+                fileobj.write(encoder.encode(o))
+                return
+            sep = '{'
+            for k, v in custom(o).iteritems():
+                fileobj.write(sep)
+                fileobj.write(encoder.encode(k))
+                fileobj.write(': ')
+                write(v)
+                sep = ', '
+            fileobj.write('}')
+        write(obj)
 
     @staticmethod
     def from_json(s, objectify=True, remapper={}, fallback={}):
@@ -85,52 +236,62 @@ class Serializable(object):
         the code is reorganized, so that classes that used to be defined in a module 
         can be found if they are moved into a new module. 
         """
-        def hook(o):
-            meta_module, meta_class = None, o.get('meta_class')
-            if meta_class == 'datetime.datetime':
-                try:
-                    tmp = datetime.datetime.strptime(
-                        o['date'], '%Y-%m-%dT%H:%M:%S.%f')
-                except Exception, e:
-                    tmp = datetime.datetime.strptime(
-                        o['date'], '%Y-%m-%dT%H:%M:%S')                
-                return tmp
-            elif meta_class == 'set':
-                return set(o['set'])
-            elif meta_class == '%s.ndarray' % numpy.__name__:
-                data = base64.b64decode(o['data'])
-                dtype = o['dtype']
-                shape = o['shape']
-                v = numpy.frombuffer(data, dtype=dtype)
-                v = v.reshape(shape)
-                v.setflags(write=True)
-                return v
-
-            elif meta_class and '.' in meta_class:
-                # correct for classes that have migrated from one module to another
-                meta_class = remapper.get(meta_class, meta_class)
-                # separate the module name from the actual class name
-                meta_module, meta_class = meta_class.rsplit('.',1)
-
-            if meta_class is not None:              
-                del o['meta_class']                
-                # this option is for backward compatibility, in case classes
-                # change the module where they can be found.
-                if meta_class in fallback:
-                    meta_module = fallback.get(meta_class)
-                
-                if meta_module is not None and objectify:
-                    prefix = ''
-                    module = importlib.import_module(prefix+meta_module)
-                    cls = getattr(module, meta_class)
-                    obj = cls()
-                    obj.__dict__.update(o)
-                    o = obj
-            elif type(o).__name__ == 'dict':
-                o = Storage(o)                
-            return o
+        return json.loads(s, object_hook=_decoder(objectify, remapper, fallback))
+
+    @staticmethod
+    def load(fileobj, objectify=True, remapper={}, fallback={}, blobs=None):
+        """Like from_json, but reads the json from fileobj.  blobs is the
+        binary file to which dump wrote the arrays, if any."""
+        read_blob = None
+        if blobs is not None:
+            read_blob = lambda offset, dtype, shape: _read_blob(blobs, offset, dtype, shape)
+        return json.load(fileobj, object_hook=_decoder(objectify, remapper, fallback, read_blob))
+
+    @staticmethod
+    def dump_container(obj, fileobj, tolerant=True):
+        """Writes obj to the binary file fileobj as a container: the json,
+        without the data of the numpy arrays, followed by a binary section
+        with the raw data of the arrays, to which the json refers by offset.
+        The container must be the whole file."""
+        blobs = tempfile.TemporaryFile()
+        try:
+            Serializable.dump(obj, fileobj, pack_ndarray=True, tolerant=tolerant, blobs=blobs)
+            base = fileobj.tell()
+            padding = -base % BLOB_ALIGNMENT
+            fileobj.write('\0' * padding)
+            base += padding
+            blobs.seek(0)
+            shutil.copyfileobj(blobs, fileobj)
+            fileobj.write(CONTAINER_FOOTER.pack(base, CONTAINER_MAGIC))
+        finally:
+            blobs.close()
+
+    @staticmethod
+    def from_container(buf, objectify=True, remapper={}, fallback={}, writable=None):
+        """Decodes a container from a buffer, such as a string, a bytearray
+        or an mmap.  The arrays are views over the buffer, without copies;
+        they are writable if the buffer is, unless writable is False."""
+        if not is_container(buf):
+            raise ValueError("Not a json_plus container")
+        base, magic = CONTAINER_FOOTER.unpack(str(buf[-CONTAINER_FOOTER.size:]))
+        if writable is None:
+            writable = not isinstance(buf, str)
+        read_blob = _view_blob(buf, base, writable)
+        return json.loads(str(buf[:base]).rstrip('\0'),
+                          object_hook=_decoder(objectify, remapper, fallback, read_blob))
 
-        return json.loads(s, object_hook=hook)
+    @staticmethod
+    def load_container(filename, objectify=True, remapper={}, fallback={}, writable=False):
+        """Loads a container from a file, which is mapped in memory; the
+        arrays are views over the map, so that their data are read only
+        when used.  They are read-only, unless writable is True, in which
+        case the map is copy-on-write: the pages written are copied, and
+        the changes are not written back to the file."""
+        with open(filename, 'rb') as f:
+            access = mmap.ACCESS_COPY if writable else mmap.ACCESS_READ
+            buf = mmap.mmap(f.fileno(), 0, access=access)
+        return Serializable.from_container(buf, objectify=objectify, remapper=remapper,
+                                           fallback=fallback, writable=writable)
 
     @staticmethod
     def loads(s):
@@ -176,7 +337,44 @@ class TestSerializable(unittest.TestCase):
         a.x = 123456789012345678901234567890L
         b = Serializable.from_json(a.to_json())
         self.assertEqual(b.x, a.x)
-        
+
+    def test_stream(self):
+        a = Serializable()
+        a.x = numpy.array([[1,2,3],[4,5,6]], dtype=numpy.int32)
+        a.y = Serializable()
+        a.y.z = numpy.arange(5.0)
+        a.w = {'k': [1, 'two']}
+        f, blobs = io.BytesIO(), io.BytesIO()
+        Serializable.dump(a, f, pack_ndarray=True, blobs=blobs)
+        self.assertNotIn('"data"', f.getvalue())
+        f.seek(0)
+        b = Serializable.load(f, blobs=blobs)
+        self.assertTrue(numpy.array_equal(a.x, b.x))
+        self.assertEqual(b.x.dtype, numpy.int32)
+        self.assertTrue(numpy.array_equal(a.y.z, b.y.z))
+        self.assertEqual(b.w.k, [1, 'two'])
+        b.y.z[0] = 1.0
+
+    def test_container(self):
+        a = Serializable()
+        a.x = numpy.array([[1,2,3],[4,5,6]], dtype=numpy.int32)
+        a.y = Serializable()
+        a.y.z = numpy.arange(5.0)
+        a.e = numpy.zeros((0, 3))
+        f = tempfile.NamedTemporaryFile(suffix='.json')
+        Serializable.dump_container(a, f)
+        f.flush()
+        b = Serializable.load_container(f.name)
+        self.assertTrue(numpy.array_equal(a.x, b.x))
+        self.assertTrue(numpy.array_equal(a.y.z, b.y.z))
+        self.assertEqual(b.e.shape, (0, 3))
+        self.assertRaises(ValueError, b.y.z.__setitem__, 0, 1.0)
+        c = Serializable.load_container(f.name, writable=True)
+        c.y.z[0] = 1.0
+        d = Serializable.from_container(bytearray(open(f.name, 'rb').read()))
+        self.assertEqual(d.y.z[0], 0.0)
+        d.y.z[0] = 1.0
+
 
 if __name__ == '__main__':
     unittest.main()
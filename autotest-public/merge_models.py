@@ -0,0 +1,48 @@
+import glob
+import os
+import sys
+from stat_engine import StatModel
+
+# Reduces the models of a function learned on several hosts into one fleet model.
+#   python merge_models.py <output.model> <model file or directory> ...
+# Directories contribute the models among the .model and .json files they
+# contain; other files, such as switches.json, are skipped.
+
+def model_files(paths):
+    """Yields each file, and whether it was found in a directory."""
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(glob.glob(os.path.join(path, '*.model')) +
+                                   glob.glob(os.path.join(path, '*.json'))):
+                yield filename, True
+        else:
+            yield path, False
+
+def merge_models(output, paths):
+    """Merges the models in paths, writes the result to output,
+    and returns the number of models merged."""
+    model = None
+    n = 0
+    for filename, found in model_files(paths):
+        with open(filename, 'rb') as f:
+            try:
+                other = StatModel.deserialize(f.read())
+            except ValueError:
+                if not found:
+                    raise
+                print 'skipping %s, which is not a model' % filename
+                continue
+        # The first model sets the time scales and histograms of the result.
+        model = other if model is None else model.merge(other)
+        n += 1
+    if model is None:
+        model = StatModel()
+    with open(output, 'wb') as f:
+        f.write(model.to_binary())
+    return n
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print 'usage: python merge_models.py <output.model> <model file or directory> ...'
+        sys.exit(1)
+    print 'merged %d models' % merge_models(sys.argv[1], sys.argv[2:])
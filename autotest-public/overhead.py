@@ -0,0 +1,190 @@
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# Accounting of the overhead that autotest adds to the instrumented
+# functions.  Each instrumented function has a Counters object, kept in a
+# process-wide registry, counting its calls, the calls sampled for checking,
+# and the time spent in each stage of the pipeline:
+#   snapshot: copying or valuizing the input and output (autotest),
+#   learn, test: running the engines (autotest); this includes
+#   valuize: flattening the input and output (StatEngine), and
+#   persist: serializing and writing models and tests (engines).
+
+STAGES = ('snapshot', 'valuize', 'learn', 'test', 'persist')
+
+class Counters(object):
+    """Overhead counters of one instrumented function.
+    calls and sampled are incremented without locking, as they are updated
+    on every call; with several threads, a few increments may be lost."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.sampled = 0
+        self.seconds = dict((stage, 0.0) for stage in STAGES)
+        self._lock = threading.Lock()
+
+    def add(self, stage, start):
+        """Adds to stage the time elapsed since start (a time.time())."""
+        elapsed = time.time() - start
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + elapsed
+
+    def total(self):
+        """Returns the total overhead, in seconds.  This excludes valuize
+        and persist, which are part of learn."""
+        with self._lock:
+            return self.seconds['snapshot'] + self.seconds['learn'] + self.seconds['test']
+
+    def report(self):
+        """Returns the counters as a dictionary."""
+        with self._lock:
+            seconds = dict(self.seconds)
+        total = sum(seconds[stage] for stage in ('snapshot', 'learn', 'test'))
+        return dict(calls=self.calls,
+                    sampled=self.sampled,
+                    seconds=seconds,
+                    total_seconds=total,
+                    us_per_call=1e6 * total / self.calls if self.calls else 0.0)
+
+# Counters of each instrumented function, by module and qualified name.
+_registry = {}
+_registry_lock = threading.Lock()
+
+def get_counters(module, name):
+    """Returns the counters of function name of module, creating them if needed."""
+    key = '%s.%s' % (module, name)
+    with _registry_lock:
+        counters = _registry.get(key)
+        if counters is None:
+            counters = _registry[key] = Counters(key)
+        return counters
+
+def report():
+    """Returns the counters of all the instrumented functions, as a
+    dictionary indexed by function name."""
+    with _registry_lock:
+        all_counters = list(_registry.values())
+    return dict((c.name, c.report()) for c in all_counters)
+
+def hottest(n=10):
+    """Returns the names and reports of the n functions with the most overhead."""
+    return sorted(report().items(), key=lambda item: -item[1]['total_seconds'])[:n]
+
+def reset():
+    """Forgets all the counters."""
+    with _registry_lock:
+        _registry.clear()
+
+def dump(filename):
+    """Writes the report, as json, to filename."""
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(report(), f, indent=2, sort_keys=True)
+    os.rename(tmp_filename, filename)
+
+class Dumper(object):
+    """Dumps the report to filename every interval seconds, and at exit."""
+
+    def __init__(self, filename, interval=60.0):
+        self.filename = filename
+        self.interval = interval
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='autotest-overhead')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            dump(self.filename)
+
+    def stop(self):
+        """Stops the periodic dumps, and dumps a last time."""
+        if not self._stop.is_set():
+            self._stop.set()
+            # Otherwise the thread may still be waiting when the interpreter exits.
+            if self.thread is not threading.current_thread():
+                self.thread.join()
+            dump(self.filename)
+
+
+class _FakeTime(object):
+    """Stands for the time module, with a time set by the tests."""
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+class TestOverhead(unittest.TestCase):
+
+    def setUp(self):
+        global time
+        self.saved = time, dict(_registry)
+        time = _FakeTime(100.0)
+        reset()
+
+    def tearDown(self):
+        global time
+        time = self.saved[0]
+        reset()
+        _registry.update(self.saved[1])
+
+    def run_calls(self, counters, calls, sampled, seconds):
+        """Counts calls, of which sampled spend the given seconds in each stage."""
+        counters.calls += calls
+        counters.sampled += sampled
+        for i in range(sampled):
+            for stage, t in seconds.items():
+                start = time.time()
+                time.now += t
+                counters.add(stage, start)
+
+    def test_counters(self):
+        c = get_counters('m', 'f')
+        self.assertTrue(get_counters('m', 'f') is c)
+        self.assertEqual(c.report(), dict(calls=0, sampled=0, seconds=dict.fromkeys(STAGES, 0.0),
+                                          total_seconds=0.0, us_per_call=0.0))
+        self.run_calls(c, 10, 2, dict(snapshot=0.5, learn=1.0, valuize=0.25, test=0.25))
+        r = c.report()
+        self.assertEqual((r['calls'], r['sampled']), (10, 2))
+        self.assertEqual(r['seconds'], dict(snapshot=1.0, learn=2.0, valuize=0.5, test=0.5, persist=0.0))
+        # valuize is part of learn, and not counted twice.
+        self.assertEqual(r['total_seconds'], 3.5)
+        self.assertEqual(c.total(), 3.5)
+        self.assertEqual(r['us_per_call'], 350000.0)
+
+    def test_report(self):
+        self.run_calls(get_counters('m', 'f'), 1, 1, dict(learn=1.0))
+        self.run_calls(get_counters('m', 'g'), 1, 1, dict(learn=3.0))
+        self.run_calls(get_counters('n', 'f'), 1, 1, dict(test=2.0))
+        r = report()
+        self.assertEqual(sorted(r), ['m.f', 'm.g', 'n.f'])
+        self.assertEqual(r['n.f']['total_seconds'], 2.0)
+        self.assertEqual([name for name, _ in hottest()], ['m.g', 'n.f', 'm.f'])
+        self.assertEqual(hottest(1), [('m.g', r['m.g'])])
+        reset()
+        self.assertEqual((report(), hottest()), ({}, []))
+
+    def test_dump(self):
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        filename = os.path.join(dirname, 'overhead.json')
+        self.run_calls(get_counters('m', 'f'), 4, 1, dict(snapshot=0.5))
+        dump(filename)
+        with open(filename) as f:
+            self.assertEqual(json.load(f), report())
+        self.assertEqual(os.listdir(dirname), ['overhead.json'])
+        dumper = Dumper(filename, interval=3600.0)
+        get_counters('m', 'f').calls += 1
+        dumper.stop()
+        self.assertFalse(dumper.thread.is_alive())
+        with open(filename) as f:
+            self.assertEqual(json.load(f)['m.f']['calls'], 5)
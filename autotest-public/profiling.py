@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import unittest
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Measures the cost of the calls of instrumented functions, so that the
+# engines can learn it along with their behavior.  The measures are a
+# dictionary that StatEngine valuizes under PERF_PREFIX.
+
+# Prefix of the variables describing the cost of a call.
+PERF_PREFIX = '__perf__'
+
+wall_clock = getattr(time, 'perf_counter', time.time)
+
+def cpu_time():
+    """Returns the CPU time used by the process, in seconds."""
+    if hasattr(time, 'process_time'):
+        return time.process_time()
+    if resource is not None:
+        # Finer than os.times, which counts in clock ticks (usually 10 ms).
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        return r.ru_utime + r.ru_stime
+    t = os.times()
+    return t[0] + t[1]
+
+def max_rss_kb():
+    """Returns the peak resident set size of the process, in KB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, OS X bytes.
+    return rss / 1024.0 if sys.platform == 'darwin' else float(rss)
+
+class Profiler(object):
+    """Measures wall time and CPU time around a call, and, if memory is
+    True, its memory: the net allocation (alloc_kb) if tracemalloc is
+    tracing (Python 3), otherwise the growth of the peak resident set
+    size of the process (peak_rss_growth_kb).  The peak never decreases,
+    so once the process is warmed up the growth is 0 for most calls, and
+    only calls that need more memory than any before show.  CPU time and
+    the peak are per process, so they also count the work of other
+    threads."""
+
+    def __init__(self, memory=True):
+        self.memory = memory
+
+    def _memory(self):
+        if not self.memory:
+            return None
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            return 'alloc_kb', tracemalloc.get_traced_memory()[0] / 1024.0
+        if resource is not None:
+            return 'peak_rss_growth_kb', max_rss_kb()
+        return None
+
+    def start(self):
+        """Starts a measure, and returns the state to pass to stop."""
+        return self._memory(), cpu_time(), wall_clock()
+
+    def stop(self, state):
+        """Returns the dictionary of the measures since start."""
+        wall = wall_clock()
+        cpu = cpu_time()
+        memory, cpu_start, wall_start = state
+        perf = dict(wall_ms=(wall - wall_start) * 1000.0,
+                    cpu_ms=(cpu - cpu_start) * 1000.0)
+        end_memory = self._memory() if memory is not None else None
+        if end_memory is not None and end_memory[0] == memory[0]:
+            perf[memory[0]] = end_memory[1] - memory[1]
+        return perf
+
+
+class _FakeClock(object):
+    """Clock returning the given times, one per call."""
+    def __init__(self, *times):
+        self.times = list(times)
+
+    def __call__(self):
+        return self.times.pop(0)
+
+class _FakeTracemalloc(object):
+    """tracemalloc returning the given traced sizes, or not tracing for None."""
+    def __init__(self, *traced):
+        self.traced = list(traced)
+
+    def is_tracing(self):
+        if self.traced[0] is None:
+            self.traced.pop(0)
+            return False
+        return True
+
+    def get_traced_memory(self):
+        return self.traced.pop(0), 0
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        global wall_clock, cpu_time, max_rss_kb, tracemalloc, resource
+        self.saved = wall_clock, cpu_time, max_rss_kb, tracemalloc, resource
+        wall_clock = _FakeClock(10.0, 10.25)
+        cpu_time = _FakeClock(3.0, 3.125)
+        tracemalloc = None
+
+    def tearDown(self):
+        global wall_clock, cpu_time, max_rss_kb, tracemalloc, resource
+        wall_clock, cpu_time, max_rss_kb, tracemalloc, resource = self.saved
+
+    def test_times(self):
+        p = Profiler(memory=False)
+        self.assertEqual(p.stop(p.start()), dict(wall_ms=250.0, cpu_ms=125.0))
+
+    def test_rss(self):
+        global max_rss_kb, resource
+        max_rss_kb = _FakeClock(1000.0, 1512.0)
+        # resource is only checked for None, as max_rss_kb is fake.
+        resource = self.saved[-1] or object()
+        p = Profiler()
+        self.assertEqual(p.stop(p.start()), dict(wall_ms=250.0, cpu_ms=125.0, peak_rss_growth_kb=512.0))
+
+    def test_no_memory(self):
+        global resource
+        resource = None
+        p = Profiler()
+        self.assertEqual(p.stop(p.start()), dict(wall_ms=250.0, cpu_ms=125.0))
+
+    def test_tracemalloc(self):
+        global tracemalloc
+        tracemalloc = _FakeTracemalloc(4096, 1024)
+        p = Profiler()
+        self.assertEqual(p.stop(p.start()), dict(wall_ms=250.0, cpu_ms=125.0, alloc_kb=-3.0))
+
+    def test_memory_source_changed(self):
+        global max_rss_kb, tracemalloc, resource
+        # Tracing started during the call: the two measures cannot be compared.
+        max_rss_kb = _FakeClock(1000.0)
+        resource = self.saved[-1] or object()
+        tracemalloc = _FakeTracemalloc(None, 2048)
+        p = Profiler()
+        self.assertEqual(p.stop(p.start()), dict(wall_ms=250.0, cpu_ms=125.0))
+
+    def test_cpu_time(self):
+        cpu = self.saved[1]
+        start = cpu()
+        sum(x * x for x in xrange(200000))
+        self.assertTrue(cpu() > start)
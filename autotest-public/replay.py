@@ -0,0 +1,251 @@
+import argparse
+import cPickle as pickle
+import glob
+import importlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
+import unittest
+import func_engine
+from xml.etree import ElementTree
+
+# Replays in bulk the test cases recorded by FuncEngine for a module.
+#   python replay.py <module> [--processes N] [--timeout S] [--json FILE] [--junit FILE]
+
+# Default time limit for each case, in seconds.
+DEFAULT_TIMEOUT = 10
+
+PASSED = 'passed'
+FAILED = 'failed'
+ERROR = 'error'
+TIMEOUT = 'timeout'
+
+_FROM_RE = re.compile(r'^from (\S+) import \S+$', re.M)
+_FUNC_RE = re.compile(r'^        func = (\S+)$', re.M)
+_INPUT_RE = re.compile(r'^INPUT = (.*)$', re.M)
+_OUTPUT_RE = re.compile(r'^OUTPUT = (.*)$', re.M)
+_HASH_RE = re.compile(r'_([0-9a-f]{32})\.py$')
+
+def load_cases(module, directory='autotests'):
+    """Returns the cases recorded for module, both as unittest files and in
+    .cases files, as tuples (case id, module, qualified function name,
+    is method, serialized input, serialized output).
+    A case found both ways, such as the unittest files exported from a
+    .cases file, is returned once, from its unittest file."""
+    prefix = os.path.join(directory, module) + '_'
+    cases = []
+    # Function and input hash of the cases found so far.
+    seen = set()
+    for filename in sorted(glob.glob(prefix + '*.py')):
+        with open(filename) as f:
+            text = f.read()
+        m = _FROM_RE.search(text)
+        if m is None or m.group(1) != module:
+            continue
+        qualified_function_name = _FUNC_RE.search(text).group(1)
+        m = _HASH_RE.search(filename)
+        if m is not None:
+            seen.add((qualified_function_name, m.group(1)))
+        cases.append((filename, module, qualified_function_name,
+                      'obj = args[0]' in text,
+                      _INPUT_RE.search(text).group(1), _OUTPUT_RE.search(text).group(1)))
+    for filename in sorted(glob.glob(prefix + '*.cases')):
+        h = func_engine.read_cases_header(filename)
+        if h['module'] != module:
+            continue
+        for input_hash, _, serial_input, serial_output in func_engine.read_cases(filename):
+            if (h['qualified_function_name'], input_hash) in seen:
+                continue
+            cases.append(('%s:%s' % (filename, input_hash), module, h['qualified_function_name'],
+                          h['is_method'], serial_input, serial_output))
+    return cases
+
+# Functions already imported by this process.
+_functions = {}
+
+def _get_function(module, qualified_function_name):
+    key = (module, qualified_function_name)
+    if key not in _functions:
+        f = importlib.import_module(module)
+        for name in qualified_function_name.split('.'):
+            f = getattr(f, name)
+        # We replay the original function, not the instrumented one.
+        _functions[key] = getattr(f, '__wrapped__', f)
+    return _functions[key]
+
+class _Timeout(Exception):
+    pass
+
+def _on_alarm(signum, frame):
+    raise _Timeout()
+
+def run_case(case, timeout=DEFAULT_TIMEOUT):
+    """Runs a case, and returns a dictionary describing the result."""
+    case_id, module, qualified_function_name, is_method, serial_input, serial_output = case
+    result = dict(id=case_id, function='%s.%s' % (module, qualified_function_name))
+    t = time.time()
+    has_alarm = timeout and hasattr(signal, 'setitimer')
+    if has_alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        func = _get_function(module, qualified_function_name)
+        args, kwargs = eval(serial_input)
+        expected = eval(serial_output)
+        output = func(*args, **kwargs)
+        if output != expected[0]:
+            result.update(status=FAILED, message='output %r != %r' % (output, expected[0]))
+        elif is_method and args[0].__dict__ != expected[1]:
+            result.update(status=FAILED, message='state %r != %r' % (args[0].__dict__, expected[1]))
+        else:
+            result.update(status=PASSED)
+    except _Timeout:
+        result.update(status=TIMEOUT, message='timeout after %s s' % timeout)
+    except Exception:
+        result.update(status=ERROR, message=traceback.format_exc())
+    finally:
+        if has_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    result['time'] = time.time() - t
+    return result
+
+def _run_case_args(args):
+    return run_case(*args)
+
+def replay(cases, processes=1, timeout=DEFAULT_TIMEOUT):
+    """Runs the cases, on a pool of processes if processes > 1,
+    and returns the list of results."""
+    jobs = [(case, timeout) for case in cases]
+    if processes > 1 and len(cases) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            chunksize = max(1, len(jobs) // (4 * processes))
+            return pool.map(_run_case_args, jobs, chunksize)
+        finally:
+            pool.terminate()
+    return map(_run_case_args, jobs)
+
+def summarize(module, results, elapsed):
+    summary = dict(module=module, total=len(results), time=elapsed, cases=results)
+    for status in (PASSED, FAILED, ERROR, TIMEOUT):
+        summary[status] = sum(1 for r in results if r['status'] == status)
+    return summary
+
+def write_junit(summary, filename):
+    suite = ElementTree.Element('testsuite', name=summary['module'],
+                                tests=str(summary['total']),
+                                failures=str(summary[FAILED]),
+                                errors=str(summary[ERROR] + summary[TIMEOUT]),
+                                time='%.3f' % summary['time'])
+    for r in summary['cases']:
+        case = ElementTree.SubElement(suite, 'testcase', classname=r['function'],
+                                      name=r['id'], time='%.3f' % r['time'])
+        if r['status'] == FAILED:
+            ElementTree.SubElement(case, 'failure', message=r['message'])
+        elif r['status'] != PASSED:
+            ElementTree.SubElement(case, 'error', message=r['message'])
+    ElementTree.ElementTree(suite).write(filename, encoding='utf-8')
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replays the cases recorded by FuncEngine for a module.')
+    parser.add_argument('module')
+    parser.add_argument('--dir', default='autotests', help='directory of the recorded cases')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='seconds per case')
+    parser.add_argument('--json', help='file where to write the json summary')
+    parser.add_argument('--junit', help='file where to write the JUnit xml summary')
+    args = parser.parse_args(argv)
+    sys.path.insert(0, os.getcwd())
+    t = time.time()
+    results = replay(load_cases(args.module, args.dir), args.processes, args.timeout)
+    summary = summarize(args.module, results, time.time() - t)
+    for r in results:
+        if r['status'] != PASSED:
+            print '%s %s: %s' % (r['status'].upper(), r['id'], r['message'])
+    print '%d cases: %d passed, %d failed, %d errors, %d timeouts in %.2f s' % (
+        summary['total'], summary[PASSED], summary[FAILED], summary[ERROR], summary[TIMEOUT],
+        summary['time'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if args.junit:
+        write_junit(summary, args.junit)
+    return 0 if summary[PASSED] == summary['total'] else 1
+
+
+MODULE_SOURCE = '''import time
+
+def double(x):
+    return 2 * x
+
+def wait(seconds):
+    time.sleep(seconds)
+'''
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dirname)
+        self.module = 'replay_test_%d' % os.getpid()
+        with open(os.path.join(self.dirname, self.module + '.py'), 'w') as f:
+            f.write(MODULE_SOURCE)
+        sys.path.insert(0, self.dirname)
+        self.addCleanup(sys.path.remove, self.dirname)
+        self.engine = func_engine.FuncEngine(
+            module=self.module, base_name=os.path.join(self.dirname, 'autotests', self.module),
+            class_name='double', flat_function_name='double', qualified_function_name='double')
+
+    def case(self, serial_input, serial_output, function='double'):
+        return ('case', self.module, function, False, serial_input, serial_output)
+
+    def test_load_cases(self):
+        store = func_engine.PackedCaseStore(self.engine)
+        for i in range(3):
+            serial_input = func_engine.serialize(((i, ), {}))
+            store.add(func_engine.canonical_hash(((i, ), {})), serial_input,
+                      func_engine.serialize((2 * i, None)))
+        directory = os.path.join(self.dirname, 'autotests')
+        self.assertEqual(len(load_cases(self.module, directory)), 3)
+        # The unittest files exported from the store hold the same cases.
+        func_engine.export_tests(store.filename)
+        cases = load_cases(self.module, directory)
+        self.assertEqual(len(cases), 3)
+        self.assertTrue(all(c[0].endswith('.py') for c in cases))
+        self.assertEqual([r['status'] for r in replay(cases)], [PASSED] * 3)
+        self.assertEqual(load_cases('other', directory), [])
+
+    def test_run_case(self):
+        self.assertEqual(run_case(self.case('((3, ), {})', '(6, None)'))['status'], PASSED)
+        result = run_case(self.case('((3, ), {})', '(7, None)'))
+        self.assertEqual(result['status'], FAILED)
+        self.assertEqual(result['message'], 'output 6 != 7')
+        result = run_case(self.case('(("3", ), {})', '(6, None)', 'missing'))
+        self.assertEqual(result['status'], ERROR)
+        self.assertTrue('AttributeError' in result['message'])
+
+    def test_timeout(self):
+        # The timeout is not rounded up to whole seconds.
+        result = run_case(self.case('((2, ), {})', '(None, None)', 'wait'), timeout=0.2)
+        self.assertEqual(result['status'], TIMEOUT)
+        self.assertTrue(result['time'] < 1.0, result['time'])
+        result = run_case(self.case('((0.01, ), {})', '(None, None)', 'wait'), timeout=0.2)
+        self.assertEqual(result['status'], PASSED)
+
+    def test_processes(self):
+        cases = [self.case('((%d, ), {})' % i, '(%d, None)' % (2 * i)) for i in range(8)]
+        cases.append(self.case('((1, ), {})', '(3, None)'))
+        results = replay(cases, processes=2)
+        self.assertEqual([r['status'] for r in results], [PASSED] * 8 + [FAILED])
+        summary = summarize(self.module, results, 0.0)
+        self.assertEqual((summary['total'], summary[PASSED], summary[FAILED]), (9, 8, 1))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
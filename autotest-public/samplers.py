@@ -0,0 +1,345 @@
+import random
+import threading
+import time
+import unittest
+import profiling
+
+# Sampling policies decide which calls of an instrumented function are
+# passed to the autotest engines.  Each instrumented function has its own
+# sampler, since samplers keep state.
+
+# Key of the switches file under which per-function sampling specs are stored.
+SAMPLING_KEY = '__sampling__'
+
+class Sampler(object):
+    """Samples every call."""
+    def sample(self):
+        """Returns True if the current call should be checked."""
+        return True
+
+class ProbabilitySampler(Sampler):
+    """Samples each call independently with a fixed probability."""
+    def __init__(self, probability):
+        self.probability = probability
+
+    def sample(self):
+        return random.random() < self.probability
+
+class TokenBucketSampler(Sampler):
+    """Samples at most rate calls per second on average, with bursts
+    of up to burst calls.  clock returns the time in seconds."""
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, self.rate))
+        self.clock = clock
+        self.tokens = self.burst
+        self.last_time = clock()
+
+    def sample(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+class FirstNThenEveryKSampler(Sampler):
+    """Samples the first calls, and then one call every k
+    (none, if every is 0)."""
+    def __init__(self, first, every):
+        self.first = first
+        self.every = every
+        self.calls = 0
+
+    def sample(self):
+        self.calls += 1
+        return self.calls <= self.first or (
+            self.every > 0 and (self.calls - self.first) % self.every == 0)
+
+class Budget(object):
+    """Limits the overhead of autotest to a fraction of the CPU time of the
+    process (process_time), and optionally of each function to per_function.
+    The cost of the checks is measured by the overhead counters, in
+    wall-clock time, so checks that block count fully against the budget.
+    Every interval seconds of clock, the budget is divided among the functions
+    sampled by the AdaptiveSamplers registered with it by water-filling:
+    the functions whose checks would cost less than an equal share get
+    all they need, and the rest is split equally among the costlier ones.
+    Each sampler then samples with probability share / cost, so the
+    probability rises again when the calls become fewer or cheaper; it at
+    most doubles at each interval, so that a function called in bursts
+    does not exceed the budget when a burst starts."""
+
+    def __init__(self, fraction, per_function=None, interval=1.0, min_probability=0.001,
+                 clock=time.time, process_time=profiling.cpu_time):
+        self.fraction = fraction
+        self.per_function = per_function
+        self.interval = interval
+        # Keeps sampling a little, so that the cost estimates stay current.
+        self.min_probability = min_probability
+        self.clock = clock
+        self.process_time = process_time
+        self.samplers = []
+        self.last_time = clock()
+        self.last_process_time = process_time()
+        self._lock = threading.Lock()
+
+    def register(self, sampler):
+        with self._lock:
+            self.samplers.append(sampler)
+
+    def maybe_update(self, now=None):
+        """Reallocates the budget, if an interval has elapsed since the last time."""
+        if now is None:
+            now = self.clock()
+        if now - self.last_time < self.interval or not self._lock.acquire(False):
+            return
+        try:
+            if now - self.last_time >= self.interval:
+                self.last_time = now
+                process_time = self.process_time()
+                elapsed = process_time - self.last_process_time
+                # If the process has not run, the next interval counts for both.
+                if elapsed > 0:
+                    self.last_process_time = process_time
+                    self._allocate(elapsed)
+        finally:
+            self._lock.release()
+
+    def _allocate(self, elapsed):
+        measures = [s.measure() for s in self.samplers]
+        # The rate of the calls is estimated on the CPU time not spent in autotest,
+        # as the calls become more frequent when fewer are checked.
+        free = max(elapsed - sum(spent for eligible, cost, spent in measures), 0.01 * elapsed)
+        # Overhead per second that each function would have if all its eligible calls were sampled.
+        demands = [eligible * cost / free for eligible, cost, spent in measures]
+        remaining = self.fraction
+        cap = self.per_function if self.per_function is not None else self.fraction
+        order = sorted(range(len(demands)), key=lambda i: demands[i])
+        for n, i in enumerate(order):
+            share = min(demands[i], cap, remaining / (len(order) - n))
+            remaining -= share
+            if demands[i] > 0:
+                sampler = self.samplers[i]
+                sampler.probability = max(self.min_probability,
+                                          min(1.0, share / demands[i], 2.0 * sampler.probability))
+
+class AdaptiveSampler(Sampler):
+    """Samples the calls accepted by the sampler base with the probability
+    set by a Budget, based on the cost of the checks measured by the
+    overhead counters of the function."""
+
+    def __init__(self, budget, counters, base=None):
+        self.budget = budget
+        self.counters = counters
+        self.base = base or Sampler()
+        self.probability = 1.0
+        # Calls accepted by base since the last allocation.
+        self.eligible = 0
+        # Estimated overhead of one sampled call, in seconds; None until measured.
+        self.cost = None
+        self.last_sampled = counters.sampled
+        self.last_total = counters.total()
+        budget.register(self)
+
+    def sample(self):
+        self.budget.maybe_update()
+        if not self.base.sample():
+            return False
+        self.eligible += 1
+        return self.probability >= 1.0 or random.random() < self.probability
+
+    def measure(self):
+        """Returns the number of eligible calls since the last measure, the
+        estimated cost of sampling one, and the overhead spent, and starts a
+        new interval."""
+        sampled, total = self.counters.sampled, self.counters.total()
+        spent = total - self.last_total
+        if sampled > self.last_sampled:
+            cost = spent / (sampled - self.last_sampled)
+            self.cost = cost if self.cost is None else 0.5 * (self.cost + cost)
+        self.last_sampled, self.last_total = sampled, total
+        eligible, self.eligible = self.eligible, 0
+        return eligible, self.cost or 0.0, spent
+
+def parse_spec(s):
+    """Parses a sampling spec of the form 'rate=100,burst=10' into a dictionary."""
+    spec = {}
+    for item in s.split(','):
+        k, v = item.split('=', 1)
+        spec[k.strip()] = float(v)
+    return spec
+
+def make_sampler(spec=None):
+    """Builds a sampler from a spec, which can be:
+    - None, to sample every call;
+    - a number, the probability with which each call is sampled;
+    - a dictionary, or a string parsed by parse_spec, with keys
+      probability, or rate and optionally burst, or first and every;
+    - a function returning a sampler, or a sampler."""
+    if spec is None:
+        return Sampler()
+    if isinstance(spec, Sampler):
+        return spec
+    if callable(spec):
+        return spec()
+    if isinstance(spec, basestring):
+        spec = parse_spec(spec)
+    if isinstance(spec, (int, long, float)):
+        return ProbabilitySampler(spec)
+    if 'probability' in spec:
+        return ProbabilitySampler(spec['probability'])
+    if 'rate' in spec:
+        return TokenBucketSampler(spec['rate'], spec.get('burst'))
+    if 'first' in spec:
+        return FirstNThenEveryKSampler(int(spec['first']), int(spec.get('every', 1)))
+    raise ValueError("Unknown sampling spec %r" % (spec, ))
+
+
+class TestSamplers(unittest.TestCase):
+
+    def test_probability(self):
+        random.seed(0)
+        sampler = ProbabilitySampler(0.1)
+        n = sum(sampler.sample() for i in range(10000))
+        self.assertTrue(900 < n < 1100)
+        self.assertFalse(any(ProbabilitySampler(0.0).sample() for i in range(100)))
+        self.assertTrue(all(ProbabilitySampler(1.0).sample() for i in range(100)))
+
+    def test_token_bucket(self):
+        now = [0.0]
+        sampler = TokenBucketSampler(2, burst=3, clock=lambda: now[0])
+        # A burst, then nothing until tokens accumulate.
+        self.assertEqual([sampler.sample() for i in range(5)], [True, True, True, False, False])
+        now[0] += 0.5
+        self.assertEqual([sampler.sample() for i in range(2)], [True, False])
+        # The tokens do not accumulate beyond the burst.
+        now[0] += 100.0
+        self.assertEqual(sum(sampler.sample() for i in range(10)), 3)
+        # One call every 10 seconds.
+        now[0] += 100.0
+        sampler = TokenBucketSampler(0.1, clock=lambda: now[0])
+        self.assertEqual([sampler.sample() for i in range(2)], [True, False])
+        now[0] += 9.0
+        self.assertFalse(sampler.sample())
+        now[0] += 1.0
+        self.assertTrue(sampler.sample())
+
+    def test_first_then_every(self):
+        sampler = FirstNThenEveryKSampler(3, 4)
+        self.assertEqual([i for i in range(1, 16) if sampler.sample()], [1, 2, 3, 7, 11, 15])
+        sampler = FirstNThenEveryKSampler(2, 0)
+        self.assertEqual([i for i in range(1, 10) if sampler.sample()], [1, 2])
+
+    def test_parse_spec(self):
+        self.assertEqual(parse_spec('rate=100,burst=10'), dict(rate=100.0, burst=10.0))
+        self.assertEqual(parse_spec(' first = 5 , every=2'), dict(first=5.0, every=2.0))
+        self.assertEqual(parse_spec('probability=1e-3'), dict(probability=0.001))
+        for spec in ('rate', 'rate=fast', 'rate=1,', ''):
+            self.assertRaises(ValueError, parse_spec, spec)
+
+    def test_make_sampler(self):
+        self.assertEqual(type(make_sampler()), Sampler)
+        sampler = make_sampler(0.5)
+        self.assertEqual((type(sampler), sampler.probability), (ProbabilitySampler, 0.5))
+        sampler = make_sampler('probability=0.25')
+        self.assertEqual((type(sampler), sampler.probability), (ProbabilitySampler, 0.25))
+        sampler = make_sampler('rate=10,burst=2')
+        self.assertEqual((type(sampler), sampler.rate, sampler.burst), (TokenBucketSampler, 10.0, 2.0))
+        self.assertEqual(make_sampler(dict(rate=0.5)).burst, 1.0)
+        sampler = make_sampler('first=5,every=3')
+        self.assertEqual((type(sampler), sampler.first, sampler.every), (FirstNThenEveryKSampler, 5, 3))
+        self.assertEqual(make_sampler(dict(first=5)).every, 1)
+        self.assertTrue(make_sampler(sampler) is sampler)
+        self.assertTrue(make_sampler(lambda: sampler) is sampler)
+        self.assertRaises(ValueError, make_sampler, 'burst=10')
+        self.assertRaises(ValueError, make_sampler, {})
+
+class _FakeCounters(object):
+    """Overhead counters whose values are set by the tests."""
+    def __init__(self):
+        self.sampled = 0
+        self.seconds = 0.0
+
+    def total(self):
+        return self.seconds
+
+class TestBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.cpu = 0.0
+        self.budget = Budget(0.1, interval=1.0, clock=lambda: self.now,
+                             process_time=lambda: self.cpu)
+
+    def run_interval(self, cpu, *calls):
+        """Advances the clocks by an interval, during which each sampler has
+        (eligible, sampled, seconds) calls, samples and overhead."""
+        for (sampler, counters), (eligible, sampled, seconds) in zip(self.samplers, calls):
+            sampler.eligible += eligible
+            counters.sampled += sampled
+            counters.seconds += seconds
+        self.now += 1.0
+        self.cpu += cpu
+        self.budget.maybe_update()
+
+    def add_samplers(self, n):
+        self.samplers = []
+        for i in range(n):
+            counters = _FakeCounters()
+            self.samplers.append((AdaptiveSampler(self.budget, counters), counters))
+        return [sampler for sampler, counters in self.samplers]
+
+    def test_water_filling(self):
+        cheap, costly = self.add_samplers(2)
+        self.run_interval(10.0, (10, 10, 0.01), (100, 100, 1.0))
+        free = 10.0 - 1.01
+        demand_cheap, demand_costly = 0.01 / free, 1.0 / free
+        self.assertEqual(cheap.probability, 1.0)
+        self.assertAlmostEqual(costly.probability, (0.1 - demand_cheap) / demand_costly)
+        self.assertAlmostEqual(costly.cost, 0.01)
+
+    def test_per_function(self):
+        self.budget.per_function = 0.01
+        cheap, costly = self.add_samplers(2)
+        self.run_interval(10.0, (10, 10, 0.01), (100, 100, 1.0))
+        self.assertEqual(cheap.probability, 1.0)
+        self.assertAlmostEqual(costly.probability, 0.01 / (1.0 / (10.0 - 1.01)))
+
+    def test_probability_bounds(self):
+        sampler, = self.add_samplers(1)
+        self.run_interval(1.0, (1000, 1000, 10.0))
+        self.assertEqual(sampler.probability, self.budget.min_probability)
+        # The calls stop being costly: the probability doubles at each interval.
+        for i in range(3):
+            self.run_interval(1.0, (1, 1, 0.0))
+            self.assertAlmostEqual(sampler.probability, self.budget.min_probability * 2 ** (i + 1))
+
+    def test_interval(self):
+        sampler, = self.add_samplers(1)
+        sampler.eligible = 100
+        self.now += 0.5
+        self.cpu += 0.5
+        self.budget.maybe_update()
+        self.assertEqual(sampler.eligible, 100)
+        # No CPU time used: the allocation waits for the next interval.
+        self.budget.last_process_time = self.cpu
+        self.now += 1.0
+        self.budget.maybe_update()
+        self.assertEqual(sampler.eligible, 100)
+        self.now += 1.0
+        self.cpu += 1.0
+        self.budget.maybe_update()
+        self.assertEqual(sampler.eligible, 0)
+
+    def test_sample(self):
+        sampler, = self.add_samplers(1)
+        sampler.probability = 0.25
+        random.seed(1)
+        n = sum(sampler.sample() for i in range(1000))
+        self.assertEqual(sampler.eligible, 1000)
+        self.assertTrue(200 < n < 300)
+        sampler.base = FirstNThenEveryKSampler(0, 0)
+        self.assertFalse(sampler.sample())
+        self.assertEqual(sampler.eligible, 1000)
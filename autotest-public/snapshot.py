@@ -0,0 +1,178 @@
+import copy
+import unittest
+import valuize
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Strategies to snapshot the input of an instrumented function before
+# the call, in increasing order of cost.  Each engine declares, in its
+# snapshot_strategy attribute, the one it needs, and the decorator uses
+# the most expensive one requested by its engines.
+
+# The arguments are passed as they are; for engines that do not look at
+# the input, or that do not care if the function modifies it.
+NO_COPY = 0
+# The arguments are flattened by valuize before the call; the engines
+# receive a Valuized object instead of the arguments.
+VALUIZE = 1
+# Lists, tuples and dicts are rebuilt, immutable values are shared,
+# numpy arrays are copied with a single memory copy, and other objects
+# are deep-copied.
+ARRAY_COPY = 2
+# Full copy.deepcopy.
+DEEPCOPY = 3
+
+# Prefixes under which the two parts of the input and output are valuized.
+INPUT_PREFIXES = ('input', 'input_state')
+OUTPUT_PREFIXES = ('output', 'output_state')
+
+class Valuized(tuple):
+    """Pair of segments describing the two parts of an input or output.
+    Each segment is a pair (keys, values) of the entries produced by
+    valuize (see valuize.Valuizer)."""
+    pass
+
+_IMMUTABLE = set([type(None), bool, int, long, float, complex, str, unicode])
+
+def array_copy(ob, memo=None):
+    """Copies ob, rebuilding lists, tuples and dicts, sharing immutable values,
+    and copying numpy arrays without going through deepcopy."""
+    if memo is None:
+        memo = {}
+    t = type(ob)
+    if t in _IMMUTABLE:
+        return ob
+    i = id(ob)
+    if i in memo:
+        return memo[i]
+    if t is list:
+        y = memo[i] = []
+        y.extend(array_copy(v, memo) for v in ob)
+    elif t is dict:
+        y = memo[i] = {}
+        for k, v in ob.iteritems():
+            y[k] = array_copy(v, memo)
+    elif t is tuple:
+        # A tuple can only be built after its items; as in deepcopy, if
+        # copying them copied the tuple (through a cycle), that copy is kept.
+        y = tuple([array_copy(v, memo) for v in ob])
+        if i in memo:
+            return memo[i]
+        memo[i] = y
+    elif numpy is not None and t is numpy.ndarray:
+        y = memo[i] = ob.copy()
+    else:
+        # deepcopy uses the same memo, keyed by id.
+        y = copy.deepcopy(ob, memo)
+    return y
+
+def take(strategy, value, prefixes=INPUT_PREFIXES, valuizers=None):
+    """Snapshots value, which is a pair such as the (args, kwargs) of a call,
+    according to the strategy.  valuizers, if given, is a dictionary of
+    valuize.Valuizer by prefix, created as needed, that compile the
+    valuization of the layouts seen."""
+    if strategy == NO_COPY:
+        return value
+    elif strategy == VALUIZE:
+        if valuizers is None:
+            return Valuized(_valuized(prefix, v) for prefix, v in zip(prefixes, value))
+        return Valuized(_valuizer(valuizers, prefix)(v) for prefix, v in zip(prefixes, value))
+    elif strategy == ARRAY_COPY:
+        return array_copy(value)
+    else:
+        return copy.deepcopy(value)
+
+def _valuized(prefix, ob):
+    d = {}
+    valuize.valuize(d, prefix, ob)
+    keys = tuple(d)
+    return keys, [d[k] for k in keys]
+
+def _valuizer(valuizers, prefix):
+    v = valuizers.get(prefix)
+    if v is None:
+        v = valuizers.setdefault(prefix, valuize.Valuizer(prefix))
+    return v
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_no_copy(self):
+        value = (([1], ), {})
+        self.assertTrue(take(NO_COPY, value) is value)
+
+    def test_valuize(self):
+        value = (([1, 'a'], ), {'k': 2.5})
+        v = take(VALUIZE, value)
+        self.assertTrue(isinstance(v, Valuized))
+        self.assertEqual(dict(zip(*v[0]))['input[0][0]'], 1.0)
+        self.assertEqual(dict(zip(*v[1])), {'input_state.k': 2.5, 'len(input_state)': 1})
+        valuizers = {}
+        for i in range(2):
+            w = take(VALUIZE, value, OUTPUT_PREFIXES, valuizers)
+            self.assertEqual(sorted(valuizers), sorted(OUTPUT_PREFIXES))
+            self.assertEqual([dict(zip(*s)) for s in w],
+                             [dict(zip(*s)) for s in take(VALUIZE, value, OUTPUT_PREFIXES)])
+
+    def test_array_copy(self):
+        class A(object):
+            pass
+        a = A()
+        a.l = [1]
+        shared = [2]
+        value = (([a, shared, shared, 'x', (3, shared)], ), {'k': {'j': 1.5}})
+        c = take(ARRAY_COPY, value)
+        self.assertEqual(c[0][0][1:4], value[0][0][1:4])
+        self.assertFalse(c[0][0] is value[0][0] or c[1]['k'] is value[1]['k'])
+        self.assertEqual(c[1], value[1])
+        self.assertTrue(c[0][0][3] is value[0][0][3])
+        # Objects are deep-copied, and shared values stay shared.
+        self.assertFalse(c[0][0][0] is a or c[0][0][0].l is a.l)
+        self.assertEqual(c[0][0][0].l, [1])
+        self.assertTrue(c[0][0][1] is c[0][0][2] is c[0][0][4][1])
+        self.assertFalse(c[0][0][1] is shared)
+        if numpy is not None:
+            m = numpy.arange(6.0).reshape(2, 3)
+            c = array_copy([m, m])
+            self.assertTrue(c[0] is c[1])
+            self.assertFalse(c[0] is m)
+            self.assertTrue((c[0] == m).all())
+            m[0, 0] = 9.0
+            self.assertEqual(c[0][0, 0], 0.0)
+
+    def test_cycles(self):
+        l = [1]
+        l.append(l)
+        c = array_copy(l)
+        self.assertTrue(c[1] is c)
+        self.assertFalse(c is l)
+        # A tuple found again while copying its items.
+        l = []
+        t = (l, 2)
+        l.append(t)
+        c = array_copy(t)
+        self.assertTrue(c[0][0] is c)
+        self.assertFalse(c[0] is l)
+        # The same, through an object copied by deepcopy.
+        class A(object):
+            pass
+        a = A()
+        t = (a, 1)
+        a.t = t
+        c = array_copy([t])
+        self.assertTrue(c[0][0].t is c[0])
+        d = {}
+        d['d'] = d
+        c = array_copy(d)
+        self.assertTrue(c['d'] is c)
+
+    def test_deepcopy(self):
+        l = [1]
+        value = (([l, l], ), {})
+        c = take(DEEPCOPY, value)
+        self.assertEqual(c, value)
+        self.assertTrue(c[0][0][0] is c[0][0][1])
+        self.assertFalse(c[0][0][0] is l)
@@ -1,15 +1,25 @@
 import autotest
+import itertools
 import json
-import math
+import mmap
 import os
+import struct
 import sys
+import time
 import valuize
 import json_plus
 import numpy as np
 import unittest
+import profiling
+import snapshot
 import storage_engines
 from loggers import DefaultLogger
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # This engine checks the statistical consistency of the code behavior.
 
 # Exponent of 10 for longest time scale at which to produce statistics.
@@ -26,8 +36,38 @@ SIGNIFICANT_SIGMAS = 4.0 # In real applications, at least 3.0
 
 EPSILON = 1e-8
 
+# Number of key tuples for which StatModel caches the rows.
+ROWS_CACHE_SIZE = 64
+
+# Histograms: number of buckets per variable and time scale when enabled.
+# The buckets are evenly spaced in sign(x) * log(1 + |x|) between
+# -HIST_RANGE and HIST_RANGE, so that they cover values of any magnitude
+# with bounded memory; values beyond the range go to the end buckets.
+HIST_BUCKETS = 128
+HIST_RANGE = np.log1p(1e6)
+
+# Eviction policies, for models with a maximum number of variables:
+# evict the variable seen least recently, or the one with the least
+# (discounted) weight at the longest time scale.
+EVICT_LRU = 'lru'
+EVICT_WEIGHT = 'weight'
+
+# Binary format of the models: a BINARY_HEADER (magic, version, number of
+# time scale bins, capacity, number of variables, step, offset of the
+# table), then for each array in StatModel.ROW_ARRAYS a block of float64
+# with capacity rows, then a json table of the variable names, array
+# shapes and model settings.
+BINARY_MAGIC = 'ATSMODEL'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<8sIIQQdQ')
+# Magic of the shared model files that have been replaced by larger ones.
+RETIRED_MAGIC = 'ATSMDEAD'
+
 class StatEngine(autotest.ExampleEngine):
 
+    # We only need the flattened values of the input.
+    snapshot_strategy = snapshot.VALUIZE
+
     def __init__(self,
                  mfunc=None,
                  mclass=None,
@@ -42,7 +82,12 @@ class StatEngine(autotest.ExampleEngine):
                  class_name='class',
                  flat_function_name='flat_function',
                  qualified_function_name='qual_name',
-                 switches=None):
+                 switches=None,
+                 half_lives=None,
+                 histograms=False,
+                 max_vars=None,
+                 eviction=EVICT_LRU,
+                 overhead=None):
         self.mfunc = mfunc
         self.mclass = mclass
         self.mattr = mattr
@@ -57,10 +102,26 @@ class StatEngine(autotest.ExampleEngine):
         self.flat_function_name = flat_function_name
         self.qualified_function_name = qualified_function_name
         self.switches = switches or {}
-        self.file_name = os.path.join(base_name, qualified_function_name) + ".json"
+        # Overhead counters of the function (see the overhead module).
+        self.overhead = overhead
+        # Half-lives in seconds of the time scales of new models, for wall-clock decay;
+        # None to decay per call.
+        self.half_lives = half_lives
+        # Whether new models also keep histograms, to detect changes of distribution.
+        self.hist_buckets = HIST_BUCKETS if histograms else 0
+        # Maximum number of variables tracked, and eviction policy beyond it.
+        self.max_vars = max_vars
+        self.eviction = eviction
+        self.file_name = os.path.join(base_name, qualified_function_name) + ".model"
+        # Where models used to be saved in json.
+        self.json_file_name = os.path.join(base_name, qualified_function_name) + ".json"
 
         # Model used for learning.
         self.model = None
+        # Compiled valuizers, for the inputs and outputs that are not yet valuized.
+        self.valuizers = {}
+        # Keys of the profiling measures, by their names.
+        self._perf_keys = {}
 
         # Number of unsaved runs.
         self.num_unsaved_runs = 0
@@ -71,15 +132,21 @@ class StatEngine(autotest.ExampleEngine):
     def _load(self):
         """Loads the statistical model."""
         if self.model is None:
-            json_data = self.storage_engine.read(self.file_name)
-            self.model = StatModel.deserialize(json_data) if json_data else StatModel()
+            data = (self.storage_engine.read(self.file_name) or
+                    self.storage_engine.read(self.json_file_name))
+            self.model = StatModel.deserialize(data) if data else StatModel(self.half_lives, self.hist_buckets)
+            if self.max_vars is not None:
+                self.model.set_max_vars(self.max_vars, self.eviction)
 
     def _save(self):
         """Saves the statistical model."""
         dr = self.file_name.rsplit(os.sep, 1)[0]
         if not os.path.exists(dr):
             os.makedirs(dr)
-        self.storage_engine.write(self.model.serialize(), self.file_name)
+        start = time.time()
+        self.storage_engine.write(self.model.to_binary(), self.file_name)
+        if self.overhead is not None:
+            self.overhead.add('persist', start)
 
     def _maybe_save(self):
         self.num_unsaved_runs += 1
@@ -87,24 +154,43 @@ class StatEngine(autotest.ExampleEngine):
             self.log2_unsaved_runs += 1
             self._save()
 
-    def learn(self, input, output):
-        """Updates the statistical model, and checks for inconsistencies."""
+    def learn(self, input, output, perf=None):
+        """Updates the statistical model, and checks for inconsistencies.
+        The cost of the call, if profiled, is learned like its behavior, so
+        that performance regressions raise the same alarms."""
         print 'Learning...'
         self._load()
-        # Forms a dictionary describing what the input and output look like,
-        # so we can then compute the various statistics.
-        v = dict(input_state=input[1], input=input[0], output=output[0], output_state=output[1])
-        d = {}
-        valuize.valuize(d, '', v)
-        # Sends the dictionary to the learner.
-        self.model.learn(d)
+        # Describes what the input and output look like, as segments of
+        # keys and values, so we can then compute the various statistics.
+        start = time.time()
+        segments = []
+        for value, prefixes in ((input, snapshot.INPUT_PREFIXES), (output, snapshot.OUTPUT_PREFIXES)):
+            if not isinstance(value, snapshot.Valuized):
+                # Not already flattened when the snapshot was taken.
+                value = snapshot.take(snapshot.VALUIZE, value, prefixes, self.valuizers)
+            segments.extend(value)
+        if perf:
+            names = tuple(sorted(perf))
+            keys = self._perf_keys.get(names)
+            if keys is None:
+                keys = self._perf_keys[names] = tuple('%s.%s' % (profiling.PERF_PREFIX, k) for k in names)
+            segments.append((keys, [perf[k] for k in names]))
+        if self.overhead is not None:
+            self.overhead.add('valuize', start)
+        # Sends the segments to the learner.
+        self.model.learn_segments(segments)
         # From now and then, saves the model.
         self._maybe_save()
 
     def test(self, input, output):
         print 'Testing... %s.py and function %s:' % (self.module, self.qualified_function_name)
         significance = self.switches.get(self.qualified_function_name, SIGNIFICANT_SIGMAS)
+        if significance == 'off':
+            return
         ok, msg = self.model.check(significance)
+        if self.model.hist_buckets:
+            ok_dist, msg_dist = self.model.check_distribution(significance)
+            ok, msg = ok and ok_dist, msg + msg_dist
         if not ok:
             print "Change of behavior detected"
             print "Input State:", repr(input[1])
@@ -115,17 +201,80 @@ class StatEngine(autotest.ExampleEngine):
             if self.exit_on_error:
                 sys.exit(-1)
 
+def _read_binary_header(buf):
+    """Checks the header of a model in binary format, and returns its
+    capacity, number of variables, step, and table offset."""
+    (magic, version, num_bins, capacity, num_vars,
+     step, table_offset) = BINARY_HEADER.unpack_from(buf, 0)
+    if magic != BINARY_MAGIC or version > BINARY_VERSION:
+        raise ValueError("Not a StatModel, or unsupported version %d" % version)
+    if num_bins != NUM_BINS:
+        raise ValueError("The model has %d time scale bins instead of %d" % (num_bins, NUM_BINS))
+    return capacity, num_vars, step, table_offset
+
 class StatModel(json_plus.Serializable):
-    """Statistical model in python."""
+    """Statistical model in python.
+
+    The statistics are kept in columnar form: each statistic is a matrix
+    with one row per variable and one column per time scale, and
+    self.index maps each variable name to its row.  Only the first
+    self.num_vars rows are in use; the rest is spare capacity.
+
+    Time decay is lazy: the statistics of a variable are discounted only
+    when the variable is read or updated, by coeffs ** (steps elapsed since
+    self.last_step of the row).
+
+    If half_lives is given, the time scales are defined in wall-clock time
+    rather than in calls: time scale k has a half-life of half_lives[k]
+    seconds, step is the time of the latest observation, and last_step the
+    time each variable was last discounted.  In that mode count_since_alarm
+    holds the seconds elapsed since the variable was first seen or since the
+    latest alarm, so that the alarms wait for a half-life of data.
+
+    If hist_buckets is nonzero, the model also keeps for each variable and
+    time scale a discounted histogram of its values (see HIST_RANGE), which
+    is used to estimate quantiles and to test for changes in distribution
+    that do not move the mean.
+
+    If max_vars is nonzero, at most max_vars variables are tracked: a new
+    variable takes the row of a variable evicted according to the eviction
+    policy (EVICT_LRU or EVICT_WEIGHT), and self.evictions counts the
+    variables evicted or left untracked."""
 
-    def __init__(self):
+    # Per-variable arrays, with one row per variable.
+    ROW_ARRAYS = ('sum_x', 'sum_xx', 'weights', 'count', 'count_since_alarm', 'last_step', 'hist',
+                  'last_seen')
+    # Attributes saved in the table of the binary format, with their defaults.
+    SETTINGS = ('half_lives', 'hist_buckets', 'max_vars', 'eviction', 'evictions')
+    half_lives = None
+    hist_buckets = 0
+    max_vars = 0
+    eviction = EVICT_LRU
+    evictions = 0
+
+    def __init__(self, half_lives=None, hist_buckets=0):
         """Produces a blank learning model."""
-        self.vars = set()
-        self.sum_x = {}
-        self.sum_xx = {}
-        self.weights = {}
-        self.count = {} # Count of total number of data, to avoid giving alerts too early.
-        self.count_since_alarm = {} # Count of data since last alarm.
+        if half_lives is not None and len(half_lives) != NUM_BINS:
+            raise ValueError("half_lives must have %d elements" % NUM_BINS)
+        self.half_lives = None if half_lives is None else [float(h) for h in half_lives]
+        self.hist_buckets = hist_buckets
+        self.names = [] # Variable name of each row.
+        self.index = {} # Row of each variable name.
+        self.num_vars = 0
+        self.sum_x = np.zeros((0, NUM_BINS))
+        self.sum_xx = np.zeros((0, NUM_BINS))
+        self.weights = np.zeros((0, NUM_BINS))
+        self.count = np.zeros(0) # Count of total number of data, to avoid giving alerts too early.
+        self.count_since_alarm = np.zeros((0, NUM_BINS)) # Count of data since last alarm.
+        self.last_step = np.zeros(0) # Step at which each variable was last discounted.
+        self.hist = np.zeros((0, NUM_BINS, hist_buckets)) # Histograms, if hist_buckets > 0.
+        self.last_seen = np.zeros(0) # Step at which each variable was last observed.
+        self.max_vars = 0 # Maximum number of variables, or 0 for no limit.
+        self.eviction = EVICT_LRU
+        self.evictions = 0 # Number of variables evicted or left untracked.
+        self._rows_cache = {} # Keys and rows of the segments learned, by id of the keys.
+        self.last_rows = np.zeros(0, dtype=int) # Rows present in the last observation.
+        self.step = 0 # Number of observations learned, or time of the last one.
         # Let's precompute the coefficients.
         self.nprange = np.array(range(MIN_TIME_SCALE, MAX_TIME_SCALE))
         self.coeffs = 1.0 - 10.0 ** - self.nprange
@@ -133,88 +282,657 @@ class StatModel(json_plus.Serializable):
 
     @staticmethod
     def deserialize(s):
+        """Loads a model from the binary format, the json format, or a json_plus container."""
         if s is None:
             return StatModel()
-        return json_plus.Serializable.from_json(s)
+        if s.startswith(BINARY_MAGIC):
+            return StatModel.from_binary(bytearray(s))
+        if json_plus.is_container(s):
+            # The arrays are views over one writable copy of s.
+            model = json_plus.Serializable.from_container(bytearray(s))
+        else:
+            model = json_plus.Serializable.from_json(s)
+        if not isinstance(model, StatModel):
+            raise ValueError("Not a StatModel")
+        if isinstance(model.sum_x, dict):
+            model._upgrade()
+        model._add_missing_arrays(len(model.count))
+        return model
 
     def serialize(self):
+        # Brings all variables up to date, so that the saved statistics
+        # do not depend on last_step.
+        self._decay(np.arange(self.num_vars))
         return self.to_json(pack_ndarray=True, tolerant=True)
 
-    def learn(self, d):
-        """Learns from a dictionary d, which is a dictionary of key/value pairs."""
-        # First, adds to the model all the new variables in d.
-        self.last_vars = set(d.keys())
-        for v in self.last_vars - self.vars:
-            self.sum_x[v] = np.zeros(NUM_BINS)
-            self.sum_xx[v] = np.zeros(NUM_BINS)
-            self.weights[v] = np.zeros(NUM_BINS)
-            self.count[v] = 0L
-        # Then, updates all models for the variables.
-        self.vars = self.vars | self.last_vars
-        for v in self.vars:
-            # First, discounts the weights.
-            self.weights[v] *= self.coeffs
-            self.sum_x[v] *= self.coeffs
-            self.sum_xx[v] *= self.coeffs
-            # Then, if the variable is present this time, adds one more item of evidence.
-            if v in d:
-                x = d[v]
-                self.weights[v] += 1.0
-                self.sum_x[v] += x
-                self.sum_xx[v] += x * x
-                self.count[v] = min(10 ** MAX_TIME_SCALE + 1L, self.count.get(v, 0L) + 1L)
-                self.count_since_alarm[v] = np.minimum(
-                    10 ** MAX_TIME_SCALE + np.ones(NUM_BINS),
-                    self.count_since_alarm.get(v, np.zeros(NUM_BINS)) + 1L)
-
-    def check(self, significance):
+    def to_binary(self):
+        """Returns the model in binary format."""
+        self._decay(np.arange(self.num_vars))
+        return self._to_binary(self.num_vars)
+
+    def _to_binary(self, capacity):
+        """Returns the model in binary format, with room for capacity variables."""
+        n = self.num_vars
+        blocks = []
+        for k in self.ROW_ARRAYS:
+            a = getattr(self, k)
+            block = np.zeros((capacity, ) + a.shape[1:])
+            block[:n] = a[:n]
+            blocks.append(block.tostring())
+        header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, NUM_BINS, capacity, n, self.step,
+                                    BINARY_HEADER.size + sum(len(b) for b in blocks))
+        return ''.join([header] + blocks + [self._binary_table()])
+
+    def _binary_table(self):
+        return json.dumps(dict(names=self.names,
+                               arrays=[(k, getattr(self, k).shape[1:]) for k in self.ROW_ARRAYS],
+                               settings=dict((k, getattr(self, k)) for k in self.SETTINGS)))
+
+    @staticmethod
+    def from_binary(buf):
+        """Loads a model in binary format from a buffer, such as a string,
+        a bytearray or an mmap.  The arrays of the model are views over
+        the buffer if it is writable, and copies otherwise."""
+        capacity, num_vars, step, table_offset = _read_binary_header(buf)
+        table = json.loads(str(buf[table_offset:]))
+        model = StatModel()
+        model._apply_settings(table['settings'])
+        model._map_arrays(buf, capacity, table['arrays'])
+        model.names = table['names']
+        model.index = dict((v, i) for i, v in enumerate(model.names))
+        model.num_vars = num_vars
+        model.step = step
+        return model
+
+    def _apply_settings(self, settings):
+        """Sets the settings read from the table of a binary model."""
+        for k in self.SETTINGS:
+            setattr(self, k, settings.get(k, getattr(StatModel, k)))
+
+    def _row_shape(self, k):
+        """Shape of the row of each variable in the per-variable array k."""
+        if k in ('count', 'last_step', 'last_seen'):
+            return ()
+        if k == 'hist':
+            return (NUM_BINS, self.hist_buckets)
+        return (NUM_BINS, )
+
+    def _add_missing_arrays(self, capacity):
+        """Adds empty per-variable arrays in place of those that were not
+        saved, for models saved by a previous version."""
+        for k in self.ROW_ARRAYS:
+            if getattr(self, k).shape != (capacity, ) + self._row_shape(k):
+                setattr(self, k, np.zeros((capacity, ) + self._row_shape(k)))
+
+    def _map_arrays(self, buf, capacity, arrays):
+        """Makes the per-variable arrays views over the blocks of a buffer in binary format."""
+        offset = BINARY_HEADER.size
+        for k, shape in arrays:
+            shape = (capacity, ) + tuple(shape)
+            count = int(np.prod(shape))
+            a = np.frombuffer(buf, dtype=np.float64, count=count, offset=offset).reshape(shape)
+            if not a.flags.writeable:
+                a = a.copy()
+            setattr(self, k, a)
+            offset += a.nbytes
+        self._add_missing_arrays(capacity)
+
+    @staticmethod
+    def load(filename, use_mmap=False):
+        """Loads a model in binary format from a file.  If use_mmap is True,
+        the file is memory-mapped copy-on-write, so that the model is read
+        lazily and the changes to it are not written to the file."""
+        with open(filename, 'rb') as f:
+            if use_mmap:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            else:
+                buf = bytearray(f.read())
+        return StatModel.from_binary(buf)
+
+    def _upgrade(self):
+        """Converts a model saved with one dictionary of arrays per statistic
+        to the columnar layout."""
+        old = dict((k, getattr(self, k)) for k in
+                   ('sum_x', 'sum_xx', 'weights', 'count', 'count_since_alarm'))
+        names = sorted(old['weights'])
+        StatModel.__init__(self)
+        rows = self._rows(names)
+        for v, i in zip(names, rows):
+            self.sum_x[i] = old['sum_x'][v]
+            self.sum_xx[i] = old['sum_xx'][v]
+            self.weights[i] = old['weights'][v]
+            self.count[i] = old['count'].get(v, 0)
+            self.count_since_alarm[i] = old['count_since_alarm'].get(v, np.zeros(NUM_BINS))
+        for k in ('vars', 'last_vars'):
+            self.__dict__.pop(k, None)
+
+    def _grow(self, size):
+        """Ensures there is room for at least size rows, doubling the capacity as needed."""
+        capacity = len(self.count)
+        if size <= capacity:
+            return
+        new_capacity = max(size, 2 * capacity, 16)
+        for k in self.ROW_ARRAYS:
+            old = getattr(self, k)
+            new = np.zeros((new_capacity, ) + old.shape[1:])
+            new[:capacity] = old
+            setattr(self, k, new)
+
+    def set_max_vars(self, max_vars, eviction=EVICT_LRU):
+        """Limits the number of variables to max_vars (0 for no limit).
+        If the model already has more variables, the limit applies as
+        new variables replace them."""
+        if eviction not in (EVICT_LRU, EVICT_WEIGHT):
+            raise ValueError("Unknown eviction policy %r" % eviction)
+        self.max_vars = max_vars or 0
+        self.eviction = eviction
+
+    def _rows(self, names):
+        """Returns the array of rows of the variables in names, adding
+        the variables that are not yet part of the model.
+        With max_vars, the row of the variables that cannot be tracked is -1."""
+        new = [v for v in names if v not in self.index]
+        if new and self.max_vars and self.num_vars + len(new) > self.max_vars:
+            new = self._evict(new, names)
+            if not new:
+                return np.fromiter((self.index.get(v, -1) for v in names), dtype=int, count=len(names))
+        if new:
+            self._grow(self.num_vars + len(new))
+            self.last_step[self.num_vars:self.num_vars + len(new)] = self.step
+            for v in new:
+                self.index[v] = self.num_vars
+                self.names.append(v)
+                self.num_vars += 1
+        if self.max_vars:
+            return np.fromiter((self.index.get(v, -1) for v in names), dtype=int, count=len(names))
+        return np.fromiter((self.index[v] for v in names), dtype=int, count=len(names))
+
+    def _evict(self, new, names):
+        """Gives to the new variables the rows of variables that are not in
+        names, evicting them according to the eviction policy.
+        Returns the new variables that still need to be appended."""
+        room = max(self.max_vars - self.num_vars, 0)
+        busy = [self.index[v] for v in names if v in self.index]
+        candidates = np.setdiff1d(np.arange(self.num_vars), busy)
+        k = min(len(new) - room, len(candidates))
+        if k > 0:
+            if self.eviction == EVICT_WEIGHT:
+                self._decay(candidates)
+                key = self.weights[candidates, -1]
+            else:
+                key = self.last_seen[candidates]
+            victims = candidates[np.argsort(key, kind='mergesort')[:k]]
+            for i in victims:
+                del self.index[self.names[i]]
+                for a in self.ROW_ARRAYS:
+                    getattr(self, a)[i] = 0
+            self.last_step[victims] = self.step
+            for i, v in zip(victims, new[room:room + k]):
+                self.names[i] = v
+                self.index[v] = i
+        self.evictions += len(new) - room
+        return new[:room]
+
+    def _decay(self, rows):
+        """Applies the discounting that the given rows have missed since they were last touched."""
+        elapsed = self.step - self.last_step[rows]
+        if self.half_lives is None:
+            factors = self.coeffs ** elapsed[:, np.newaxis]
+        else:
+            factors = 0.5 ** (elapsed[:, np.newaxis] / np.array(self.half_lives))
+        self.weights[rows] *= factors
+        self.sum_x[rows] *= factors
+        self.sum_xx[rows] *= factors
+        if self.hist_buckets:
+            self.hist[rows] *= factors[:, :, np.newaxis]
+        self.last_step[rows] = self.step
+
+    def _scale_name(self, k):
+        """Describes time scale k."""
+        if self.half_lives is None:
+            return "10^%d iterations" % (k + MIN_TIME_SCALE)
+        return "%g s half-life" % self.half_lives[k]
+
+    def learn(self, d, now=None):
+        """Learns from a dictionary d, which is a dictionary of key/value pairs.
+        With wall-clock decay, now is the time of the observation (default: the current time)."""
+        self._advance(now)
+        names = list(d.keys())
+        rows = self._rows(names)
+        x = np.fromiter((d[v] for v in names), dtype=float, count=len(names))
+        self._update(rows, x)
+
+    def learn_segments(self, segments, now=None):
+        """Learns from a list of segments (keys, values), such as those of
+        valuize.Valuizer, where keys is a tuple of distinct variable names.
+        The rows of the variables are cached by keys object, so that
+        segments with the same keys as a previous observation are learned
+        without looking up the names."""
+        for keys, values in segments:
+            assert len(keys) == len(values), "segment has %d keys but %d values" % (len(keys), len(values))
+        self._advance(now)
+        if self.max_vars:
+            # Evictions may move variables; the rows are found all at once.
+            rows = self._rows([k for keys, values in segments for k in keys])
+        elif segments:
+            rows = np.concatenate([self._segment_rows(keys) for keys, values in segments])
+        else:
+            rows = np.zeros(0, dtype=int)
+        x = np.fromiter(itertools.chain.from_iterable(values for keys, values in segments),
+                        dtype=float, count=len(rows))
+        self._update(rows, x)
+
+    def _segment_rows(self, keys):
+        """Returns the rows of the variables in keys, caching them by keys."""
+        cached = self._rows_cache.get(id(keys))
+        if cached is not None and cached[0] is keys:
+            return cached[1]
+        rows = self._rows(keys)
+        if len(self._rows_cache) >= ROWS_CACHE_SIZE:
+            self._rows_cache.clear()
+        # Keeping keys makes sure its id is not reused.
+        self._rows_cache[id(keys)] = (keys, rows)
+        return rows
+
+    def _advance(self, now):
+        """Advances the time to that of a new observation."""
+        if self.half_lives is None:
+            self.step += 1
+        else:
+            self.step = max(self.step, time.time() if now is None else now)
+
+    def _update(self, rows, x):
+        """Adds the observation of the values x of the variables in rows (-1 if untracked)."""
+        if self.max_vars:
+            tracked = rows >= 0
+            rows, x = rows[tracked], x[tracked]
+        self.last_rows = rows
+        elapsed = self.step - self.last_step[rows]
+        self.last_seen[rows] = self.step
+        # First, discounts the variables present this time.
+        self._decay(rows)
+        # Then, adds one more item of evidence for the variables present this time.
+        self.weights[rows] += 1.0
+        self.sum_x[rows] += x[:, np.newaxis]
+        self.sum_xx[rows] += (x * x)[:, np.newaxis]
+        if self.hist_buckets:
+            # The rows are distinct, so each cell is incremented once.
+            self.hist[rows[:, np.newaxis], np.arange(NUM_BINS), self._buckets(x)[:, np.newaxis]] += 1.0
+        self.count[rows] = np.minimum(10 ** MAX_TIME_SCALE + 1, self.count[rows] + 1)
+        if self.half_lives is None:
+            self.count_since_alarm[rows] = np.minimum(10 ** MAX_TIME_SCALE + 1,
+                                                      self.count_since_alarm[rows] + 1)
+        else:
+            self.count_since_alarm[rows] = np.minimum(self.half_lives[-1] + 1,
+                                                      self.count_since_alarm[rows] + elapsed[:, np.newaxis])
+
+    def merge(self, other):
+        """Adds to this model the evidence of other, learned from a different
+        stream of calls (for instance, on another host).
+        The discounted sums are sufficient statistics: each model is brought
+        up to date with its own last observation, so that the two last
+        observations are taken as simultaneous, and the sums, weights and
+        counts of each variable are added, as if the calls of the two streams
+        had been interleaved.  The step stays that of this model.  With
+        wall-clock decay, both models are instead brought up to the later of
+        their times.  Returns self."""
+        if self.half_lives != other.half_lives:
+            raise ValueError("Cannot merge models with different time scales")
+        if self.hist_buckets != other.hist_buckets:
+            raise ValueError("Cannot merge models with different histograms")
+        if self.half_lives is not None:
+            self.step = other.step = max(self.step, other.step)
+        self._decay(np.arange(self.num_vars))
+        other._decay(np.arange(other.num_vars))
+        rows = self._rows(other.names[:other.num_vars])
+        src = np.arange(other.num_vars)
+        if self.max_vars:
+            src = src[rows >= 0]
+            rows = rows[rows >= 0]
+        self.weights[rows] += other.weights[src]
+        self.sum_x[rows] += other.sum_x[src]
+        self.sum_xx[rows] += other.sum_xx[src]
+        self.hist[rows] += other.hist[src]
+        self.last_seen[rows] = np.maximum(self.last_seen[rows], other.last_seen[src])
+        self.count[rows] = np.minimum(10 ** MAX_TIME_SCALE + 1, self.count[rows] + other.count[src])
+        if self.half_lives is None:
+            self.count_since_alarm[rows] = np.minimum(10 ** MAX_TIME_SCALE + 1,
+                                                      self.count_since_alarm[rows] + other.count_since_alarm[src])
+        else:
+            # The two streams ran at the same time: the time since the alarm is not added.
+            self.count_since_alarm[rows] = np.maximum(self.count_since_alarm[rows], other.count_since_alarm[src])
+        self.evictions += other.evictions
+        return self
+
+    def check(self, significance=SIGNIFICANT_SIGMAS):
         """Checks if there is a statistically significant discrepancy
         between long and short term behavior.
         Returns whether the results are ok, and an error message."""
+        rows = self.last_rows[self.weights[self.last_rows, 0] > 1.0]
+        if len(rows) == 0:
+            return True, ''
+        # Computes means and distribution variances.
+        weights = self.weights[rows]
+        means = self.sum_x[rows] / weights
+        variances = self.sum_xx[rows] / weights - means * means
+        # These are the variances of the means.  The distribution variance is N / (N - 1) the
+        # sample variance; the variance of the mean is the distribution variance divided by
+        # the number of points (the weight of) the mean, that is, N.
+        mean_vars = variances / (weights - 1.0)
+        # Compares each time scale k with time scale k + 1, for all variables at once.
+        mean_diff = np.abs(means[:, :-1] - means[:, 1:])
+        stdev_diff = np.sqrt(np.abs(mean_vars[:, :-1] + mean_vars[:, 1:]))
+        zero = stdev_diff == 0
+        scores = mean_diff / np.where(zero, 1.0, stdev_diff)
+        # We perform the check only once we have enough data, and if sufficient time has passed
+        # since the latest alert.
+        alarms = self._enough(rows) & ((zero & (mean_diff != 0)) | (scores > significance))
         msg = ''
-        ok = True
-        for v in self.last_vars:
-            if self.weights[v][0] > 1.0:
-                # Computes means and distribution variances.
-                means = self.sum_x[v] / self.weights[v]
-                variances = self.sum_xx[v] / self.weights[v] - means * means
-                # These are the variances of the means.  The distribution variance is N / (N - 1) the
-                # sample variance; the variance of the mean is the distribution variance divided by
-                # the number of points (the weight of) the mean, that is, N.
-                mean_vars = variances / (self.weights[v] - 1.0)
-                # Computes significance threshold for each pair of estimates.
-                for k in range(NUM_BINS - 1):
-                    # We perform the check only once we have enough data, and if sufficient time has passed
-                    # since the latest alert.
-                    if self.count[v] > self.intervals[k] and self.count_since_alarm[v][k] > self.intervals[k]:
-                        mean_diff = abs(means[k] - means[k + 1])
-                        stdev_diff = math.sqrt(abs(mean_vars[k] + mean_vars[k + 1]))
-                        
-                        if (stdev_diff == 0 and mean_diff != 0) or mean_diff / (stdev_diff or 1) > significance:
-
-                            ok = False
-                            msg += "\nQuantity %r differs from past behavior for timescale 10^%d with significance %r" % (
-                                v, k + MIN_TIME_SCALE, "infinity" if stdev_diff == 0 else mean_diff / stdev_diff)
-                            msg += "\nBehavior in last 10^%d iterations: mean = %f variance = %f variance of mean = %f" % (
-                                k + MIN_TIME_SCALE, means[k], variances[k], mean_vars[k])
-                            msg += "\nBehavior in last 10^%d iterations: mean = %f variance = %f variance of mean = %f" % (
-                                k + 1 + MIN_TIME_SCALE, means[k + 1], variances[k + 1], mean_vars[k + 1])
-                            self.count_since_alarm[v][k] = 0
-
-                            print "v:", v
-                            print "means:", means
-                            print "count:", self.count[v]
-                            print "k", k
-                            print "mean_diff", mean_diff
-                            print "stdev_diff", stdev_diff
-                            print "significance", mean_diff / stdev_diff
-                            if stdev_diff > 0:
-                                print mean_diff / stdev_diff
-
-
-
-
-        return ok, msg
+        for j, k in zip(*np.nonzero(alarms)):
+            msg += "\nQuantity %r differs from past behavior for timescale %s with significance %r" % (
+                self.names[rows[j]], self._scale_name(k),
+                "infinity" if zero[j, k] else float(scores[j, k]))
+            msg += "\nBehavior in last %s: mean = %f variance = %f variance of mean = %f" % (
+                self._scale_name(k), means[j, k], variances[j, k], mean_vars[j, k])
+            msg += "\nBehavior in last %s: mean = %f variance = %f variance of mean = %f" % (
+                self._scale_name(k + 1), means[j, k + 1], variances[j, k + 1], mean_vars[j, k + 1])
+            self.count_since_alarm[rows[j], k] = 0
+        return not msg, msg
+
+    def _enough(self, rows):
+        """Returns, for the given rows and each time scale but the last,
+        whether the scale has seen enough data since the variable appeared
+        and since its latest alarm to be checked: as many calls as its
+        interval, or with wall-clock decay, its half-life in seconds."""
+        if self.half_lives is None:
+            intervals = self.intervals[:-1]
+            return ((self.count[rows, np.newaxis] > intervals) &
+                    (self.count_since_alarm[rows, :-1] > intervals))
+        return self.count_since_alarm[rows, :-1] >= np.array(self.half_lives[:-1])
+
+    def _buckets(self, x):
+        """Returns the histogram bucket of each value in the array x."""
+        y = np.sign(x) * np.log1p(np.abs(x))
+        b = np.floor((y + HIST_RANGE) * (self.hist_buckets / (2.0 * HIST_RANGE)))
+        return np.clip(np.nan_to_num(b), 0, self.hist_buckets - 1).astype(int)
+
+    def _bucket_values(self, b):
+        """Returns the value at position b, in buckets, on the histogram scale."""
+        y = b * (2.0 * HIST_RANGE / self.hist_buckets) - HIST_RANGE
+        return np.sign(y) * np.expm1(np.abs(y))
+
+    def quantile(self, name, q, scale=0):
+        """Estimates the quantile q (between 0 and 1) of variable name at
+        the given time scale, interpolating within the histogram buckets."""
+        if not self.hist_buckets:
+            raise ValueError("The model does not keep histograms")
+        i = self.index[name]
+        self._decay(np.array([i]))
+        h = self.hist[i, scale]
+        cum = np.cumsum(h)
+        if cum[-1] <= 0:
+            return None
+        target = q * cum[-1]
+        b = min(int(np.searchsorted(cum, target)), self.hist_buckets - 1)
+        below = cum[b] - h[b]
+        frac = (target - below) / h[b] if h[b] > 0 else 0.0
+        return float(self._bucket_values(b + frac))
+
+    def check_distribution(self, significance=SIGNIFICANT_SIGMAS):
+        """Checks if the distribution of the values differs significantly
+        between long and short term behavior, comparing the histograms of
+        consecutive time scales with a two-sample chi-square test.
+        The chi-square statistic is converted to sigmas via the
+        Wilson-Hilferty approximation, so that the significance is
+        comparable to that of check.
+        Returns whether the results are ok, and an error message."""
+        if not self.hist_buckets:
+            return True, ''
+        rows = self.last_rows[self.weights[self.last_rows, 0] > 1.0]
+        if len(rows) == 0:
+            return True, ''
+        h1 = self.hist[rows, :-1]
+        h2 = self.hist[rows, 1:]
+        n1 = h1.sum(axis=2)[:, :, np.newaxis]
+        n2 = h2.sum(axis=2)[:, :, np.newaxis]
+        both = h1 + h2
+        occupied = both > 0
+        k1 = np.sqrt(n2 / np.maximum(n1, EPSILON))
+        k2 = np.sqrt(n1 / np.maximum(n2, EPSILON))
+        chi2 = np.where(occupied, (k1 * h1 - k2 * h2) ** 2 / np.where(occupied, both, 1.0), 0.0).sum(axis=2)
+        dof = np.maximum(occupied.sum(axis=2) - 1, 1)
+        c = 2.0 / (9.0 * dof)
+        scores = ((chi2 / dof) ** (1.0 / 3.0) - (1.0 - c)) / np.sqrt(c)
+        alarms = self._enough(rows) & (scores > significance)
+        msg = ''
+        for j, k in zip(*np.nonzero(alarms)):
+            name = self.names[rows[j]]
+            msg += "\nDistribution of %r differs from past behavior for timescale %s with significance %r" % (
+                name, self._scale_name(k), float(scores[j, k]))
+            for s in (k, k + 1):
+                msg += "\nBehavior in last %s: quantiles 5%% = %g 50%% = %g 95%% = %g" % (
+                    (self._scale_name(s), ) + tuple(self.quantile(name, q, s) for q in (0.05, 0.5, 0.95)))
+            self.count_since_alarm[rows[j], k] = 0
+        return not msg, msg
+
+
+class SharedStatModel(StatModel):
+    """StatModel kept in a file in binary format, memory-mapped by all the
+    processes that open it, so that they learn a single model.
+    Each operation locks the file with flock.  Variables are only ever
+    appended; when the file is full, the model is copied to a larger file,
+    which replaces the old one, and the old one is marked so that the
+    other processes reopen the model."""
+
+    # Capacity of a new file.
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, filename, half_lives=None, hist_buckets=0, initial=None):
+        """Opens the model in filename.  If the file is new, it starts from
+        the model initial if given, and otherwise from an empty model with
+        the settings."""
+        if fcntl is None:
+            raise RuntimeError("SharedStatModel requires fcntl")
+        StatModel.__init__(self, half_lives, hist_buckets)
+        self.filename = filename
+        self._initial = initial
+        self._open()
+        self._initial = None
+        self._release()
+
+    def _open(self):
+        """Opens and locks the file, creating it if needed, and maps the model."""
+        while True:
+            fd = os.open(self.filename, os.O_RDWR | os.O_CREAT)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size == 0:
+                if self._initial is not None:
+                    model = self._initial
+                    model._decay(np.arange(model.num_vars))
+                    _write_all(fd, model._to_binary(max(self.INITIAL_CAPACITY, model.num_vars)))
+                else:
+                    _write_all(fd, self._to_binary(self.INITIAL_CAPACITY))
+                break
+            os.lseek(fd, 0, os.SEEK_SET)
+            if os.read(fd, len(RETIRED_MAGIC)) != RETIRED_MAGIC:
+                break
+            # Another process moved the model to a larger file after we
+            # opened this one; we open the new one.
+            os.close(fd)
+        self._fd = fd
+        self._pid = os.getpid()
+        self._map()
+
+    def _map(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        capacity, num_vars, step, table_offset = _read_binary_header(
+            os.read(self._fd, BINARY_HEADER.size))
+        old_mm = getattr(self, '_mm', None)
+        self._mm = mmap.mmap(self._fd, table_offset)
+        self._table_offset = table_offset
+        table = self._read_table()
+        self._apply_settings(table['settings'])
+        self._map_arrays(self._mm, capacity, table['arrays'])
+        self.names = table['names']
+        self.index = dict((v, i) for i, v in enumerate(self.names))
+        self.num_vars = num_vars
+        self.step = step
+        self._names_dirty = False
+        if old_mm is not None:
+            # The arrays are now views over the new map.
+            old_mm.close()
+
+    def _read_table(self):
+        os.lseek(self._fd, self._table_offset, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self._fd, 1 << 16)
+            if not chunk:
+                return json.loads(''.join(chunks))
+            chunks.append(chunk)
+
+    def _acquire(self):
+        """Locks the model, and brings it up to date with the changes of the other processes."""
+        if os.getpid() != self._pid:
+            # We have been forked, and would share the lock with our parent.
+            os.close(self._fd)
+            self._open()
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        if self._mm[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            # Another process has moved the model to a larger file.
+            os.close(self._fd)
+            self._open()
+            return
+        _, num_vars, self.step, _ = _read_binary_header(self._mm)
+        if num_vars > self.num_vars:
+            self.names = self._read_table()['names']
+            for i in range(self.num_vars, num_vars):
+                self.index[self.names[i]] = i
+            self.num_vars = num_vars
+
+    def _release(self):
+        """Publishes our changes, and unlocks the model."""
+        if self._names_dirty:
+            table = self._binary_table()
+            os.lseek(self._fd, self._table_offset, os.SEEK_SET)
+            _write_all(self._fd, table)
+            os.ftruncate(self._fd, self._table_offset + len(table))
+            self._names_dirty = False
+        BINARY_HEADER.pack_into(self._mm, 0, BINARY_MAGIC, BINARY_VERSION, NUM_BINS, len(self.count),
+                                self.num_vars, self.step, self._table_offset)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _grow(self, size):
+        capacity = len(self.count)
+        if size <= capacity:
+            return
+        tmp_filename = self.filename + '.tmp'
+        fd = os.open(tmp_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        _write_all(fd, self._to_binary(max(size, 2 * capacity)))
+        os.rename(tmp_filename, self.filename)
+        # Tells the processes waiting for the old file to reopen the model.
+        self._mm[:len(RETIRED_MAGIC)] = RETIRED_MAGIC
+        old_fd = self._fd
+        self._fd = fd
+        self._map()
+        os.close(old_fd)
+
+    def _rows(self, names):
+        num_vars = self.num_vars
+        rows = StatModel._rows(self, names)
+        if self.num_vars > num_vars:
+            self._names_dirty = True
+        return rows
+
+    def learn(self, d, now=None):
+        self._acquire()
+        try:
+            StatModel.learn(self, d, now)
+        finally:
+            self._release()
+
+    def learn_segments(self, segments, now=None):
+        self._acquire()
+        try:
+            StatModel.learn_segments(self, segments, now)
+        finally:
+            self._release()
+
+    def check(self, significance=SIGNIFICANT_SIGMAS):
+        self._acquire()
+        try:
+            return StatModel.check(self, significance)
+        finally:
+            self._release()
+
+    def check_distribution(self, significance=SIGNIFICANT_SIGMAS):
+        self._acquire()
+        try:
+            return StatModel.check_distribution(self, significance)
+        finally:
+            self._release()
+
+    def quantile(self, name, q, scale=0):
+        self._acquire()
+        try:
+            return StatModel.quantile(self, name, q, scale)
+        finally:
+            self._release()
+
+    def to_binary(self):
+        self._acquire()
+        try:
+            return StatModel.to_binary(self)
+        finally:
+            self._release()
+
+    def merge(self, other):
+        self._acquire()
+        try:
+            return StatModel.merge(self, other)
+        finally:
+            self._release()
+
+    def set_max_vars(self, max_vars, eviction=EVICT_LRU):
+        # The rows are shared by position with the other processes.
+        if max_vars:
+            raise ValueError("SharedStatModel cannot evict variables")
+
+    def flush(self):
+        """Writes the changes to disk."""
+        self._mm.flush()
+
+def _write_all(fd, s):
+    while s:
+        s = s[os.write(fd, s):]
+
+class SharedStatEngine(StatEngine):
+    """StatEngine whose model is shared by all the processes of the host
+    that instrument the same function.  The model cannot limit the number
+    of variables (max_vars)."""
+
+    def __init__(self, *args, **kwargs):
+        StatEngine.__init__(self, *args, **kwargs)
+        if self.max_vars:
+            raise ValueError("SharedStatEngine cannot limit the number of variables")
+
+    def _load(self):
+        if self.model is None:
+            dr = self.file_name.rsplit(os.sep, 1)[0]
+            if not os.path.exists(dr):
+                os.makedirs(dr)
+            initial = None
+            if not os.path.exists(self.file_name):
+                # Imports the model saved in json by older versions, if any.
+                data = self.storage_engine.read(self.json_file_name)
+                if data:
+                    initial = StatModel.deserialize(data)
+            self.model = SharedStatModel(self.file_name, self.half_lives, self.hist_buckets, initial)
+
+    def _save(self):
+        self.model.flush()
 
 
 class TestSerializable(unittest.TestCase):
@@ -255,6 +973,246 @@ class TestSerializable(unittest.TestCase):
                 print ok, msg
             # self.assertTrue(ok)
 
+    def test_binary(self):
+        sm = StatModel()
+        for i in range(20):
+            sm.learn(dict(x=i, y=2 * i))
+        sm.learn(dict(x=1))
+        s = sm.to_binary()
+        for sm2 in (StatModel.deserialize(s), StatModel.deserialize(sm.serialize())):
+            self.assertEqual(sm2.names, sm.names)
+            self.assertEqual(sm2.step, sm.step)
+            for k in StatModel.ROW_ARRAYS:
+                self.assertTrue(np.allclose(getattr(sm2, k)[:2], getattr(sm, k)[:2]))
+            sm2.learn(dict(x=1, z=2))
+            self.assertEqual(sm2.num_vars, 3)
+
+    def test_shared(self):
+        import shutil, tempfile
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        filename = os.path.join(dirname, 'f.model')
+        a = SharedStatModel(filename)
+        b = SharedStatModel(filename)
+        for i in range(10):
+            a.learn(dict(x=1))
+        b.learn(dict(x=1, y=2))
+        self.assertEqual(b.count[b.index['x']], 11)
+        # Makes the file grow, and checks that b follows.
+        a_mm, b_mm = a._mm, b._mm
+        a.learn(dict(('z%d' % i, i) for i in range(100)))
+        b.learn(dict(x=1, z99=1))
+        # The old maps have been closed.
+        self.assertRaises(ValueError, a_mm.__getitem__, 0)
+        self.assertRaises(ValueError, b_mm.__getitem__, 0)
+        self.assertEqual(b.num_vars, 102)
+        self.assertEqual(b.count[b.index['z99']], 2)
+        self.assertEqual(StatModel.load(filename).step, 13)
+
+    def test_shared_histograms(self):
+        import shutil, tempfile
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        filename = os.path.join(dirname, 'f.model')
+        SharedStatModel(filename, hist_buckets=HIST_BUCKETS)
+        children = []
+        for c in range(4):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    sm = SharedStatModel(filename)
+                    for i in range(50):
+                        sm.learn(dict(x=i % 5, y=c))
+                        sm.check()
+                        sm.check_distribution()
+                        sm.quantile('x', 0.5)
+                    status = 0
+                finally:
+                    os._exit(status)
+            children.append(pid)
+        for pid in children:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        sm = SharedStatModel(filename)
+        self.assertEqual(sm.step, 200)
+        self.assertEqual(sm.count[sm.index['x']], 200)
+        self.assertAlmostEqual(sm.hist[sm.index['x'], 0].sum(), sm.weights[sm.index['x'], 0])
+        self.assertTrue(sm.check_distribution()[0])
+
+    def test_shared_growth(self):
+        import shutil, tempfile
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        filename = os.path.join(dirname, 'f.model')
+        children = []
+        for c in range(6):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    # Each process adds its own variables, so the file keeps growing
+                    # while the others open and use it.
+                    sm = SharedStatModel(filename)
+                    for i in range(40):
+                        sm.learn(dict(('p%d_%d' % (c, j), j) for j in range(i + 1)))
+                        if i % 10 == 9:
+                            os.close(sm._fd)
+                            sm = SharedStatModel(filename)
+                    status = 0
+                finally:
+                    os._exit(status)
+            children.append(pid)
+        for pid in children:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        sm = SharedStatModel(filename)
+        self.assertEqual(sm.num_vars, 6 * 40)
+        self.assertEqual(sm.step, 6 * 40)
+        self.assertEqual(sm.count[sm.index['p5_0']], 40)
+        self.assertEqual(sm.count[sm.index['p0_39']], 1)
+
+    def test_shared_engine(self):
+        import shutil, tempfile
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        self.assertRaises(ValueError, SharedStatEngine, base_name=dirname, max_vars=10)
+        # The model saved in json by older versions is imported.
+        sm = StatModel()
+        for i in range(5):
+            sm.learn(dict(x=i))
+        with open(os.path.join(dirname, 'f.json'), 'w') as f:
+            f.write(sm.serialize())
+        engine = SharedStatEngine(base_name=dirname, qualified_function_name='f')
+        engine._load()
+        self.assertEqual(engine.model.names, ['x'])
+        self.assertEqual(engine.model.step, 5)
+        self.assertEqual(engine.model.count[0], 5)
+
+    def test_merge(self):
+        a, b, c = StatModel(), StatModel(), StatModel()
+        for i in range(200):
+            d = dict(x=i % 7, y=1)
+            c.learn(d)
+            (a if i % 2 else b).learn(d)
+        b.learn(dict(z=3))
+        a.merge(b)
+        self.assertEqual(a.num_vars, 3)
+        self.assertEqual(a.count[a.index['x']], 200)
+        i, j = a.index['x'], c.index['x']
+        self.assertAlmostEqual(a.sum_x[i, -1] / a.weights[i, -1], c.sum_x[j, -1] / c.weights[j, -1], 2)
+
+    def test_histograms(self):
+        r = np.random.RandomState(0)
+        sm = StatModel(hist_buckets=HIST_BUCKETS)
+        for i in range(2000):
+            sm.learn(dict(x=r.normal(10, 1)))
+            self.assertTrue(sm.check_distribution()[0])
+        self.assertAlmostEqual(sm.quantile('x', 0.5), 10, delta=0.5)
+        sm = StatModel.deserialize(sm.to_binary())
+        self.assertEqual(sm.hist.shape[1:], (NUM_BINS, HIST_BUCKETS))
+        # Same mean, different distribution.
+        detected = False
+        for i in range(200):
+            sm.learn(dict(x=10 + r.choice([-3, 3])))
+            self.assertTrue(sm.check()[0])
+            detected = detected or not sm.check_distribution()[0]
+        self.assertTrue(detected)
+
+    def test_max_vars(self):
+        sm = StatModel()
+        sm.set_max_vars(3)
+        for i in range(10):
+            sm.learn(dict(x=1, y=i))
+            sm.learn({'k%d' % i: 1, 'x': 2})
+        self.assertEqual(sm.num_vars, 3)
+        self.assertEqual(sorted(sm.names), ['k9', 'x', 'y'])
+        self.assertEqual(sm.evictions, 9)
+        self.assertEqual(sm.count[sm.index['k9']], 1)
+        self.assertEqual(sm.count[sm.index['x']], 20)
+        # Variables beyond the limit are not tracked.
+        sm.learn(dict(a=1, b=2, c=3, d=4))
+        self.assertEqual(sm.num_vars, 3)
+        self.assertEqual(sm.evictions, 13)
+        sm = StatModel.deserialize(sm.to_binary())
+        self.assertEqual((sm.max_vars, sm.evictions), (3, 13))
+        sm = StatModel()
+        sm.set_max_vars(2, EVICT_WEIGHT)
+        for i in range(5):
+            sm.learn(dict(x=1))
+        sm.learn(dict(y=1))
+        sm.learn(dict(z=1))
+        self.assertEqual(sorted(sm.names), ['x', 'z'])
+
+    def test_segments(self):
+        sm1 = StatModel()
+        sm2 = StatModel()
+        v = valuize.Valuizer('input')
+        for i in range(300):
+            ob = dict(x=i % 7, y=[1.5, None], z='abc' if i < 200 else 'abd')
+            d = {}
+            valuize.valuize(d, 'input', ob)
+            d['output'] = i
+            sm1.learn(d)
+            sm2.learn_segments([v(ob), (('output', ), [i])])
+            self.assertEqual(sm1.check()[0], sm2.check()[0])
+        # The layout does not change with the values.
+        self.assertEqual(v.compiles, 1)
+        for name in sm2.names:
+            i, j = sm1.index[name], sm2.index[name]
+            self.assertTrue(np.allclose(sm1.sum_x[i], sm2.sum_x[j]))
+
+    def test_wall_clock(self):
+        sm = StatModel(half_lives=[1, 10, 100, 1000])
+        sm.learn(dict(x=1, y=1), now=1000.0)
+        sm.learn(dict(x=1), now=1010.0)
+        sm.learn(dict(y=1), now=1020.0)
+        i = sm.index['y']
+        for w, h in zip(sm.weights[i], sm.half_lives):
+            self.assertAlmostEqual(w, 1.0 + 0.5 ** (20.0 / h))
+        sm = StatModel.deserialize(sm.to_binary())
+        self.assertEqual(sm.half_lives, [1, 10, 100, 1000])
+        self.assertEqual(sm.step, 1020.0)
+
+    def test_wall_clock_alarms(self):
+        sm = StatModel(half_lives=[1, 10, 100, 1000])
+        def run(start, n, value):
+            # One call per millisecond, checked like the engine does.
+            msgs = []
+            for i in range(n):
+                sm.learn(dict(x=value + i % 2), now=start + i * 0.001)
+                ok, msg = sm.check()
+                if not ok:
+                    msgs.append(msg)
+            return msgs
+        # Many calls in less than the shortest half-life are not enough data.
+        self.assertEqual(run(1000.0, 500, 0), [])
+        self.assertEqual(run(1000.5, 300, 10), [])
+        msgs = run(1001.0, 1500, 0) + run(1002.5, 300, 10)
+        self.assertTrue(msgs)
+        self.assertTrue("timescale 1 s half-life" in msgs[0], msgs[0])
+        # The scale waits for another half-life before the next alarm.
+        self.assertEqual(len([m for m in msgs if "timescale 1 s" in m]), 1)
+
+    def test_growth(self):
+        sm = StatModel()
+        for i in range(100):
+            sm.learn(dict(('x%d' % j, j) for j in range(i + 1)))
+        self.assertEqual(sm.num_vars, 100)
+        self.assertTrue(len(sm.count) >= 100)
+        self.assertEqual(sm.count[sm.index['x0']], 100)
+        self.assertEqual(sm.count[sm.index['x99']], 1)
+        self.assertAlmostEqual(sm.sum_x[sm.index['x7'], 0] / sm.weights[sm.index['x7'], 0], 7.0)
+
+    def test_lazy_decay(self):
+        sm = StatModel()
+        sm.learn(dict(x=1, y=1))
+        for i in range(9):
+            sm.learn(dict(x=1))
+        # y has not been touched, and will be discounted when it is read.
+        self.assertEqual(sm.weights[sm.index['y'], 0], 1.0)
+        sm = StatModel.deserialize(sm.serialize())
+        for w, c in zip(sm.weights[sm.index['y']], sm.coeffs):
+            self.assertAlmostEqual(w, c ** 9)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -15,13 +15,13 @@ class FileStorageEngine(object):
     @staticmethod
     def read(filename):
         if os.path.exists(filename):
-            with open(filename) as stream:
+            with open(filename, 'rb') as stream:
                 return stream.read()
         else:
             return None
     @staticmethod
     def write(binary_data, filename):
-        with open(filename, 'w')as stream:
+        with open(filename, 'wb') as stream:
             stream.write(binary_data)
 
 
@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import samplers
 
 def switch(module, function, mode):
     mode = mode.lower()
@@ -10,6 +11,9 @@ def switch(module, function, mode):
     elif mode == 'on':
         if function in switches:
             del switches[function]
+    elif '=' in mode:
+        # Sampling spec, such as probability=0.1 or first=100,every=10
+        switches.setdefault(samplers.SAMPLING_KEY, {})[function] = samplers.parse_spec(mode)
     else:
         try:
             switches[function] = float(mode)
@@ -1,8 +1,38 @@
+import array
 import numbers
+import string
+import types
+import unittest
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # We analyze lists only up to a maximum length.
 MAX_ANALYSIS_LEN = 20
 
+# Numpy arrays and buffers are summarized rather than analyzed element by
+# element: by their length, shape, and, if numeric, mean, standard
+# deviation, min, max, number of NaNs, and these quantiles.  The summaries
+# allocate temporaries as large as the array: std and the NaN count one
+# each, the quantiles a copy.
+ARRAY_QUANTILES = ()
+
+# Maximum number of key paths kept in the cache.
+KEY_CACHE_SIZE = 100000
+
+# Strings are described by their length, and by crc(prefix), a crc32 of
+# their first STRING_PREFIX_LEN characters mapped to [0, 1).
+STRING_PREFIX_LEN = 256
+# If True, strings are described instead by hash(prefix), computed by
+# str_to_float as before crc(prefix) existed, to keep using older models.
+LEGACY_STRING_HASH = False
+# If True, strings are also described by the fraction of the bytes of
+# their (utf-8) prefix that are digits, letters, whitespace and uppercase.
+STRING_CLASSES = False
+
 def str_to_float(s):
     """Converts a string to a float."""
     t = 0.0
@@ -11,54 +41,595 @@ def str_to_float(s):
         t = (i + t) / 128.0
     return t
 
+def str_digest(s):
+    """Maps the first STRING_PREFIX_LEN characters of s to [0, 1)."""
+    s = s[:STRING_PREFIX_LEN]
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return (zlib.crc32(s) & 0xffffffff) / 4294967296.0
+
+# Character classes of STRING_CLASSES, with the characters in each.
+_CLASSES = (('digits()', string.digits), ('alpha()', string.ascii_letters),
+            ('space()', string.whitespace), ('upper()', string.ascii_uppercase))
+
+def _string_keys(prefix, legacy, classes):
+    """Returns the keys describing a string at prefix, with the settings
+    legacy (LEGACY_STRING_HASH) and classes (STRING_CLASSES)."""
+    keys = [_key(prefix, 'hash()' if legacy else 'crc()'), _key(prefix, 'len()')]
+    if classes:
+        keys.extend(_key(prefix, f) for f, chars in _CLASSES)
+    return keys
+
+def _string_values(s, legacy, classes):
+    """Returns the values describing s, in the order of _string_keys
+    with the same settings."""
+    values = [str_to_float(s) if legacy else str_digest(s), len(s)]
+    if classes:
+        b = s[:STRING_PREFIX_LEN]
+        if isinstance(b, unicode):
+            b = b.encode('utf-8')
+        n = float(len(b)) or 1.0
+        # translate deletes the characters of each class in C.
+        values.extend((len(b) - len(b.translate(None, chars))) / n for f, chars in _CLASSES)
+    return values
+
+# The valuization of an object at a given prefix (path) depends on its type.
+# The handlers write the entries of simple values to d, and return the
+# (prefix, child) pairs to valuize next, if any.
+
+def _none(d, prefix, ob, refs):
+    d[prefix] = -1.0
+
+def _real(d, prefix, ob, refs):
+    d[prefix] = float(ob)
+
+def _complex(d, prefix, ob, refs):
+    d[_key(prefix, '.real')] = ob.real
+    d[_key(prefix, '.imag')] = ob.imag
+
+def _string(d, prefix, ob, refs):
+    legacy, classes = LEGACY_STRING_HASH, STRING_CLASSES
+    for k, v in zip(_string_keys(prefix, legacy, classes), _string_values(ob, legacy, classes)):
+        d[k] = v
+
+def _dict(d, prefix, ob, refs):
+    if id(ob) in refs:
+        return None
+    refs.add(id(ob))
+    if prefix:
+        d[_key(prefix, 'len()')] = len(ob)
+        # Hmm, should I do something better here to distinguish the number 0
+        # from the string '0'?
+        return [(_key(prefix, '.', k), v) for k, v in ob.items()]
+    return [(_key('', '', k), v) for k, v in ob.items()]
+
+def _sequence(d, prefix, ob, refs):
+    if id(ob) in refs:
+        return None
+    refs.add(id(ob))
+    d[_key(prefix, 'len()')] = len(ob)
+    return [(_key(prefix, '[]', i), v) for i, v in enumerate(ob[:MAX_ANALYSIS_LEN])]
+
+def _set(d, prefix, ob, refs):
+    if id(ob) in refs:
+        return None
+    refs.add(id(ob))
+    # Not sure what best to do.
+    d[_key(prefix, 'len()')] = len(ob)
+
+def _object(d, prefix, ob, refs):
+    if id(ob) in refs:
+        return None
+    refs.add(id(ob))
+    return [(prefix, ob.__dict__)]
+
+def _array(d, prefix, ob, refs):
+    if ob.ndim == 0:
+        return [(prefix, ob[()])]
+    d[_key(prefix, 'len()')] = ob.shape[0]
+    if ob.ndim > 1:
+        shape = _key(prefix, 'shape()')
+        for i, n in enumerate(ob.shape):
+            d[_key(shape, '[]', i)] = n
+    if ob.size == 0 or ob.dtype.kind not in 'biuf':
+        return None
+    nans = 0
+    if ob.dtype.kind == 'f':
+        nans = int(np.count_nonzero(np.isnan(ob)))
+        d[_key(prefix, 'nans()')] = nans
+        if nans == ob.size:
+            return None
+    # mean, min and max need no temporary, and std one array; the nan
+    # versions copy the array, so they are used only if there are NaNs.
+    if nans:
+        stats = (np.nanmean(ob), np.nanstd(ob), np.nanmin(ob), np.nanmax(ob))
+    else:
+        stats = (ob.mean(), ob.std(), ob.min(), ob.max())
+    for f, v in zip(('mean()', 'std()', 'min()', 'max()'), stats):
+        d[_key(prefix, f)] = float(v)
+    if ARRAY_QUANTILES:
+        qs = (np.nanpercentile if nans else np.percentile)(ob, [100.0 * q for q in ARRAY_QUANTILES])
+        for q, v in zip(ARRAY_QUANTILES, qs):
+            d[_key(prefix, 'q%g()' % (100.0 * q))] = float(v)
+
+def _buffer(d, prefix, ob, refs):
+    if np is None:
+        d[_key(prefix, 'len()')] = len(ob)
+        return None
+    try:
+        if isinstance(ob, array.array):
+            a = np.frombuffer(ob, dtype=ob.typecode)
+        elif isinstance(ob, memoryview):
+            a = np.asarray(ob)
+        else:
+            a = np.frombuffer(ob, dtype=np.uint8)
+    except (TypeError, ValueError):
+        d[_key(prefix, 'len()')] = len(ob)
+        return None
+    return _array(d, prefix, a, refs)
+
+def _ignore(d, prefix, ob, refs):
+    # Boh?
+    pass
+
+# Handler of each exact type; the handlers of other types are found
+# by _handler, and added here.
+_HANDLERS = {
+    types.NoneType: _none,
+    bool: _real, int: _real, long: _real, float: _real,
+    complex: _complex,
+    str: _string, unicode: _string,
+    dict: _dict,
+    list: _sequence, tuple: _sequence,
+    set: _set,
+    bytearray: _buffer, memoryview: _buffer, buffer: _buffer, array.array: _buffer,
+}
+if np is not None:
+    _HANDLERS[np.ndarray] = _array
+
+def _handler(t, ob):
+    """Returns the handler of the objects of type t, of which ob is one."""
+    if issubclass(t, numbers.Number):
+        if issubclass(t, (numbers.Integral, numbers.Real)):
+            return _real
+        if issubclass(t, numbers.Complex):
+            return _complex
+        return _real
+    if issubclass(t, basestring):
+        return _string
+    if issubclass(t, dict):
+        return _dict
+    if issubclass(t, (list, tuple)):
+        return _sequence
+    if issubclass(t, set):
+        return _set
+    if np is not None and issubclass(t, np.ndarray):
+        return _array
+    if issubclass(t, (bytearray, memoryview, buffer, array.array)):
+        return _buffer
+    if hasattr(ob, '__dict__'):
+        return _object
+    return _ignore
+
+# Key paths, by parent path, separator, and key.
+_key_cache = {}
+
+def _key(prefix, sep, k=None):
+    """Returns the path of child k of prefix: prefix.k for dictionaries,
+    prefix[k] for sequences, f(prefix) for the sep f(), and otherwise
+    prefix + sep."""
+    # The type tells apart keys that are equal, such as 1 and 1.0.
+    ck = (prefix, sep, type(k), k)
+    s = _key_cache.get(ck)
+    if s is None:
+        if len(_key_cache) >= KEY_CACHE_SIZE:
+            _key_cache.clear()
+        if sep == '[]':
+            s = prefix + '[%d]' % k
+        elif sep.endswith('()'):
+            s = '%s(%s)' % (sep[:-2], prefix)
+        elif k is None:
+            s = prefix + sep
+        else:
+            s = prefix + sep + str(k)
+        _key_cache[ck] = s
+    return s
+
 def valuize(d, prefix, ob, refs=None):
     """Produces a dictionary string --> float describing an object ob.  
     The dictionary entries are added to an existing dictionary d, passed as input. 
-    prefix is a string prefix used as a prefix for all dictionary entries."""
-    # TODO: numpy array??
-    refs = refs or set()
-    if ob is None:
-        d[prefix] = -1.0
-    elif isinstance(ob, numbers.Number):
-        if isinstance(ob, numbers.Integral) or isinstance(ob, numbers.Real):
-            d[prefix] = float(ob)
-        elif isinstance(ob, numbers.Complex):
-            d[prefix + '.real'] = ob.real
-            d[prefix + '.imag'] = ob.imag
+    prefix is a string prefix used as a prefix for all dictionary entries.
+    The objects are visited depth-first with an explicit stack, so that
+    deep objects do not exhaust the recursion limit; containers already
+    in refs are not visited again."""
+    refs = refs if refs is not None else set()
+    handlers = _HANDLERS
+    stack = [(prefix, ob)]
+    while stack:
+        prefix, ob = stack.pop()
+        t = type(ob)
+        handler = handlers.get(t)
+        if handler is None:
+            handler = handlers[t] = _handler(t, ob)
+        children = handler(d, prefix, ob, refs)
+        if children:
+            # Visits the children in order.
+            children.reverse()
+            stack.extend(children)
+
+
+# Compiled valuizers.
+# The objects passed to an instrumented function usually have the same
+# layout call after call.  A Valuizer records the layout of the first
+# object it valuizes, and compiles a function that reads the values of
+# the objects with that layout directly, after checking (guarding) that
+# the layout is unchanged; when it changes, the Valuizer falls back to
+# valuize, and compiles the new layout.
+
+# Maximum number of layouts a Valuizer compiles, after which it only uses valuize.
+MAX_COMPILES = 8
+# Layouts with more values, or deeper, than this are not compiled.
+MAX_COMPILED_VALUES = 10000
+MAX_COMPILED_DEPTH = 100
+
+_REAL_TYPES = frozenset([bool, int, long, float])
+_STRING_TYPES = frozenset([str, unicode])
+
+class _LayoutChanged(Exception):
+    pass
+
+class _Uncompilable(Exception):
+    pass
+
+# What a compiled function raises when its guards fail.
+_LAYOUT_ERRORS = (_LayoutChanged, KeyError, IndexError, TypeError, AttributeError)
+
+def _opaque(ob, prefix, keys):
+    """Returns the values of ob, which valuize must describe by keys."""
+    d = {}
+    valuize(d, prefix, ob)
+    if len(d) != len(keys):
+        raise _LayoutChanged
+    return [d[k] for k in keys]
+
+class _Compiler(object):
+    """Generates a function returning the values of the objects with
+    the layout of a given object, in the order of self.keys."""
+
+    def __init__(self):
+        self.lines = []
+        self.env = dict(_LayoutChanged=_LayoutChanged, _opaque=_opaque, _string_values=_string_values,
+                        _REAL_TYPES=_REAL_TYPES, _STRING_TYPES=_STRING_TYPES)
+        self.keys = []
+        # Expressions of the values, and whether each is a list of values.
+        self.values = []
+        # Variables holding the containers, which must be distinct objects.
+        self.containers = []
+        self.refs = set()
+        self.num_vars = 1
+
+    def const(self, v):
+        name = 'c%d' % len(self.env)
+        self.env[name] = v
+        return name
+
+    def var(self, expr):
+        name = 'v%d' % self.num_vars
+        self.num_vars += 1
+        self.lines.append('%s = %s' % (name, expr))
+        return name
+
+    def guard(self, cond):
+        self.lines.append('if not (%s): raise _LayoutChanged' % cond)
+
+    def value(self, key, expr):
+        self.keys.append(key)
+        self.values.append((expr, False))
+
+    def container(self, ob, v):
+        if id(ob) in self.refs:
+            # Shared objects are valuized once; we do not compile this.
+            raise _Uncompilable
+        self.refs.add(id(ob))
+        self.containers.append(v)
+
+    def type_guard(self, v, t, group=None):
+        if group is not None and t in group:
+            self.guard('type(%s) in %s' % (v, self.const(group)))
         else:
-            d[prefix] = float(ob)
-    elif isinstance(ob, basestring):
-        d['hash(%s)' % prefix] = str_to_float(ob)
-        d['len(%s)' % prefix] = len(ob)
-    elif isinstance(ob, dict):
-        if not id(ob) in refs:
-            refs.add(id(ob))
-            for k, v in ob.items():
-                # Hmm, should I do something better here to distinguish the number 0
-                # from the string '0'? 
-                valuize(d, (prefix + '.' if prefix else '') + str(k), v, refs=refs)
+            self.guard('type(%s) is %s' % (v, self.const(t)))
+
+    def visit(self, prefix, ob, v, depth=0):
+        """Compiles the valuization of ob, found in variable v, at prefix."""
+        if depth > MAX_COMPILED_DEPTH or len(self.keys) > MAX_COMPILED_VALUES:
+            raise _Uncompilable
+        t = type(ob)
+        handler = _HANDLERS.get(t) or _handler(t, ob)
+        if handler is _none:
+            self.guard('%s is None' % v)
+            self.value(prefix, '-1.0')
+        elif handler is _real:
+            self.type_guard(v, t, _REAL_TYPES)
+            self.value(prefix, 'float(%s)' % v)
+        elif handler is _complex:
+            self.type_guard(v, t)
+            self.value(_key(prefix, '.real'), '%s.real' % v)
+            self.value(_key(prefix, '.imag'), '%s.imag' % v)
+        elif handler is _string:
+            self.type_guard(v, t, _STRING_TYPES)
+            # The settings are fixed when compiling, so that the values
+            # keep matching the keys if they change.
+            legacy, classes = bool(LEGACY_STRING_HASH), bool(STRING_CLASSES)
+            self.keys.extend(_string_keys(prefix, legacy, classes))
+            self.values.append(('_string_values(%s, %r, %r)' % (v, legacy, classes), True))
+        elif handler is _dict:
+            if t is not dict:
+                raise _Uncompilable
+            self.container(ob, v)
+            self.guard('type(%s) is dict and len(%s) == %d' % (v, v, len(ob)))
             if prefix:
-                d['len(%s)' % prefix] = len(ob)
-    elif isinstance(ob, list) or isinstance(ob, tuple):
-        if not id(ob) in refs:
-            refs.add(id(ob))
-            for i, v in enumerate(ob[:MAX_ANALYSIS_LEN]):
-                valuize(d, prefix + '[%d]' % i, v, refs=refs)
-            d['len(%s)' % prefix] = len(ob)
-    elif isinstance(ob, set):
-        if not id(ob) in refs:
-            refs.add(id(ob))
-            # Not sure what best to do.
-            d['len(%s)' % prefix] = len(ob)
-    elif hasattr(ob, '__dict__'):
-        if not id(ob) in refs:
-            refs.add(id(ob))
-            valuize(d, prefix, ob.__dict__)
-    else:
-        # Boh?
-        pass
+                self.value(_key(prefix, 'len()'), 'len(%s)' % v)
+            for k, child in ob.items():
+                cv = self.var('%s[%s]' % (v, self.const(k)))
+                self.visit(_key(prefix, '.', k) if prefix else _key('', '', k), child, cv, depth + 1)
+        elif handler is _sequence:
+            if t not in (list, tuple):
+                raise _Uncompilable
+            self.container(ob, v)
+            n = len(ob)
+            if n >= MAX_ANALYSIS_LEN:
+                self.guard('type(%s) is %s and len(%s) >= %d' % (v, t.__name__, v, MAX_ANALYSIS_LEN))
+            else:
+                self.guard('type(%s) is %s and len(%s) == %d' % (v, t.__name__, v, n))
+            self.value(_key(prefix, 'len()'), 'len(%s)' % v)
+            for i, child in enumerate(ob[:MAX_ANALYSIS_LEN]):
+                self.visit(_key(prefix, '[]', i), child, self.var('%s[%d]' % (v, i)), depth + 1)
+        elif handler is _object:
+            self.container(ob, v)
+            self.type_guard(v, t)
+            self.visit(prefix, ob.__dict__, self.var('%s.__dict__' % v), depth + 1)
+        else:
+            # Values that are not containers of other values, such as arrays,
+            # are valuized by valuize.
+            if handler is _set:
+                self.container(ob, v)
+            self.type_guard(v, t)
+            d = {}
+            valuize(d, prefix, ob)
+            keys = tuple(d)
+            if keys:
+                self.keys.extend(keys)
+                self.values.append(('_opaque(%s, %s, %s)' % (v, self.const(prefix), self.const(keys)), True))
+
+    def compile(self, name):
+        """Returns the compiled function."""
+        if len(self.containers) > 1:
+            self.guard('len(set([%s])) == %d' % (', '.join('id(%s)' % v for v in self.containers),
+                                                  len(self.containers)))
+        # Builds a single list of the values, a run of single values at a time,
+        # starting with a list of the first run.
+        lines = list(self.lines)
+        singles = []
+        started = False
+        for expr, is_list in self.values + [(None, True)]:
+            if not is_list:
+                singles.append(expr)
+                continue
+            if not started:
+                lines.append('out = [%s]' % ', '.join(singles))
+                started = True
+            elif len(singles) == 1:
+                lines.append('out.append(%s)' % singles[0])
+            elif singles:
+                lines.append('out.extend((%s, ))' % ', '.join(singles))
+            singles = []
+            if expr is not None:
+                lines.append('out.extend(%s)' % expr)
+        source = 'def valuized(v0):\n%s\n    return out\n' % '\n'.join('    ' + line for line in lines)
+        exec compile(source, '<valuizer %s>' % name, 'exec') in self.env
+        return self.env['valuized']
+
+def compile_layout(prefix, ob, d):
+    """Compiles the valuization at prefix of the objects with the layout of ob,
+    for which valuize produced d.  Returns the keys, and the function returning
+    the values in the order of the keys, raising an error if the layout differs."""
+    compiler = _Compiler()
+    compiler.visit(prefix, ob, 'v0')
+    keys = tuple(compiler.keys)
+    if len(set(keys)) != len(keys) or set(keys) != set(d):
+        raise _Uncompilable
+    return keys, compiler.compile(prefix)
+
+class Valuizer(object):
+    """Valuizes the objects found at prefix, such as the inputs of a function.
+    Calling it on an object returns the pair (keys, values) of the entries
+    valuize would produce.  As long as the layout of the objects does not
+    change, the values come from a compiled function, and the keys are
+    the same tuple, so that users (see StatModel.learn_segments) can cache
+    what they derive from it."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # Keys and compiled function of the current layout, or None.
+        self.layout = None
+        self.compiles = 0
+
+    def __call__(self, ob):
+        layout = self.layout
+        if layout is not None:
+            try:
+                return layout[0], layout[1](ob)
+            except _LAYOUT_ERRORS:
+                pass
+        d = {}
+        valuize(d, self.prefix, ob)
+        if self.compiles < MAX_COMPILES:
+            self.compiles += 1
+            try:
+                self.layout = layout = compile_layout(self.prefix, ob, d)
+                return layout[0], [d[k] for k in layout[0]]
+            except _Uncompilable:
+                self.layout = None
+        keys = tuple(d)
+        return keys, [d[k] for k in keys]
+
+
+class TestValuize(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = (LEGACY_STRING_HASH, STRING_CLASSES, ARRAY_QUANTILES)
+
+    def tearDown(self):
+        global LEGACY_STRING_HASH, STRING_CLASSES, ARRAY_QUANTILES
+        LEGACY_STRING_HASH, STRING_CLASSES, ARRAY_QUANTILES = self.settings
+
+    def valuized(self, ob, prefix='a'):
+        d = {}
+        valuize(d, prefix, ob)
+        return d
+
+    def test_simple(self):
+        class A(object):
+            def __init__(self):
+                self.x = 0
+                self.y = None
+        self.assertEqual(self.valuized(A()), {'a.x': 0.0, 'a.y': -1.0, 'len(a)': 2})
+        self.assertEqual(self.valuized([3, 4.5, 1j]), {'len(a)': 3, 'a[0]': 3.0, 'a[1]': 4.5,
+                                                       'a[2].real': 0.0, 'a[2].imag': 1.0})
+        self.assertEqual(self.valuized({'x': 1, 1: True}, ''), {'x': 1.0, '1': 1.0})
+        self.assertEqual(self.valuized(set([1, 2])), {'len(a)': 2})
+        d = self.valuized(range(100))
+        self.assertEqual(d['len(a)'], 100)
+        self.assertEqual(len(d), 1 + MAX_ANALYSIS_LEN)
+
+    def test_deep(self):
+        # The walker is iterative: depth is not limited by the recursion limit.
+        ob = 1
+        for i in range(5000):
+            ob = [ob]
+        d = self.valuized(ob)
+        self.assertEqual(len(d), 5001)
+        self.assertEqual(d['a' + '[0]' * 5000], 1.0)
+
+    def test_refs(self):
+        # Containers are visited once, even if shared or cyclic.
+        x = {'b': 1}
+        self.assertEqual(self.valuized([x, x]), {'len(a)': 2, 'len(a[0])': 1, 'a[0].b': 1.0})
+        ob = [1]
+        ob.append(ob)
+        self.assertEqual(self.valuized(ob), {'len(a)': 2, 'a[0]': 1.0})
+        refs = set([id(x)])
+        d = {}
+        valuize(d, 'a', [x], refs)
+        self.assertEqual(d, {'len(a)': 1})
+
+    def test_strings(self):
+        d = self.valuized('hello')
+        self.assertEqual(d, {'crc(a)': (zlib.crc32('hello') & 0xffffffff) / 4294967296.0, 'len(a)': 5})
+        self.assertEqual(self.valuized(u'h\xe9')['crc(a)'], str_digest(u'h\xe9'.encode('utf-8')))
+        # Only the prefix is hashed.
+        long1, long2 = 'x' * STRING_PREFIX_LEN + 'a', 'x' * STRING_PREFIX_LEN + 'b'
+        self.assertEqual(self.valuized(long1)['crc(a)'], self.valuized(long2)['crc(a)'])
+        self.assertTrue(0.0 <= str_digest('\xff' * 10) < 1.0)
+        global LEGACY_STRING_HASH, STRING_CLASSES
+        LEGACY_STRING_HASH = True
+        self.assertEqual(self.valuized('hello'), {'hash(a)': str_to_float('hello'), 'len(a)': 5})
+        LEGACY_STRING_HASH = False
+        STRING_CLASSES = True
+        d = self.valuized('Ab12 ')
+        self.assertEqual((d['digits(a)'], d['alpha(a)'], d['space(a)'], d['upper(a)']),
+                         (0.4, 0.4, 0.2, 0.2))
+        self.assertEqual(self.valuized('')['digits(a)'], 0.0)
+
+    @unittest.skipIf(np is None, "numpy is not available")
+    def test_arrays(self):
+        self.assertEqual(self.valuized(np.array(3.5)), {'a': 3.5})
+        self.assertEqual(self.valuized(np.array([])), {'len(a)': 0})
+        self.assertEqual(self.valuized(np.array(['x', 'y'])), {'len(a)': 2})
+        self.assertEqual(self.valuized(np.array([True, False, True, True])),
+                         {'len(a)': 4, 'mean(a)': 0.75, 'std(a)': np.sqrt(0.1875),
+                          'min(a)': 0.0, 'max(a)': 1.0})
+        self.assertEqual(self.valuized(np.array([1.0, np.nan, 3.0])),
+                         {'len(a)': 3, 'nans(a)': 1, 'mean(a)': 2.0, 'std(a)': 1.0,
+                          'min(a)': 1.0, 'max(a)': 3.0})
+        self.assertEqual(self.valuized(np.array([np.nan, np.nan])), {'len(a)': 2, 'nans(a)': 2})
+        d = self.valuized(np.zeros((2, 3)))
+        self.assertEqual((d['len(a)'], d['shape(a)[0]'], d['shape(a)[1]']), (2, 2, 3))
+        global ARRAY_QUANTILES
+        ARRAY_QUANTILES = (0.5, 0.9)
+        d = self.valuized(np.arange(11.0))
+        self.assertEqual((d['q50(a)'], d['q90(a)']), (5.0, 9.0))
+        d = self.valuized(np.array([np.nan, 1.0, 3.0]))
+        self.assertEqual(d['q50(a)'], 2.0)
+
+    @unittest.skipIf(np is None, "numpy is not available")
+    def test_buffers(self):
+        expected = {'len(a)': 2, 'mean(a)': 2.0, 'std(a)': 1.0, 'min(a)': 1.0, 'max(a)': 3.0}
+        self.assertEqual(self.valuized(bytearray('\x01\x03')), expected)
+        self.assertEqual(self.valuized(memoryview(bytearray('\x01\x03'))), expected)
+        self.assertEqual(self.valuized(buffer('\x01\x03')), expected)
+        expected['nans(a)'] = 0
+        self.assertEqual(self.valuized(array.array('d', [1.0, 3.0])), expected)
+        self.assertEqual(self.valuized(array.array('c', 'xy')), {'len(a)': 2})
+
+    def check_valuizer(self, v, ob):
+        keys, values = v(ob)
+        self.assertEqual(dict(zip(keys, values)), self.valuized(ob, v.prefix))
+        return keys
+
+    def test_valuizer(self):
+        class A(object):
+            pass
+        a = A()
+        a.x, a.s, a.l, a.n = 1, 'abc', [1.5, None, (2, 3j)], {'k': True}
+        v = Valuizer('a')
+        keys = self.check_valuizer(v, a)
+        self.assertTrue(v.layout is not None)
+        a.x, a.s, a.l[0] = 2.5, 'xyz', 7
+        # The same layout reuses the compiled function, and the same keys.
+        self.assertTrue(self.check_valuizer(v, a) is keys)
+        self.assertEqual(v.compiles, 1)
+        # A change of layout falls back to valuize, and compiles the new layout.
+        a.l.append(4)
+        self.assertFalse(self.check_valuizer(v, a) is keys)
+        a.s = None
+        self.check_valuizer(v, a)
+        del a.n
+        self.check_valuizer(v, a)
+        self.assertEqual(v.compiles, 4)
+        # The keys of the strings follow the settings at compile time.
+        global STRING_CLASSES
+        STRING_CLASSES = True
+        a.s = 'def'
+        keys = self.check_valuizer(v, a)
+        STRING_CLASSES = False
+        a.s = 'gh1'
+        new_keys, values = v(a)
+        self.assertTrue(new_keys is keys)
+        self.assertEqual(dict(zip(keys, values))['digits(a.s)'], 1.0 / 3)
+
+    def test_valuizer_fallbacks(self):
+        # Shared containers are not compiled, but valuized correctly.
+        x = [1, 2]
+        v = Valuizer('a')
+        self.check_valuizer(v, [x, x])
+        self.assertTrue(v.layout is None)
+        self.check_valuizer(v, [x, list(x)])
+        self.assertTrue(v.layout is not None)
+        # A layout that keeps changing is compiled at most MAX_COMPILES times.
+        v = Valuizer('a')
+        for i in range(2 * MAX_COMPILES):
+            self.check_valuizer(v, range(i))
+        self.assertEqual(v.compiles, MAX_COMPILES)
+        if np is not None:
+            v = Valuizer('a')
+            self.check_valuizer(v, {'m': np.arange(4.0)})
+            self.check_valuizer(v, {'m': np.arange(6.0)})
+            self.assertEqual(v.compiles, 1)
+            self.check_valuizer(v, {'m': np.zeros((2, 2))})
+            self.assertEqual(v.compiles, 2)
+
 
-            
 if __name__ == '__main__':
 
     class A(object):